@@ -0,0 +1,129 @@
+"""無 UI 的推薦服務：
+
+    python api.py serve [--host 0.0.0.0] [--port 8080]
+        GET  /recommend?budget=70&usage=家庭舒適空間&brand=TOYOTA&top_n=3
+        POST /recommend   (body 為單筆查詢物件或查詢陣列)
+        GET  /healthz
+        GET  /metrics     (Prometheus 文字格式：AI 建議快取的命中/未命中次數，讀 ADVICE_DB_PATH)
+    python api.py batch queries.jsonl [-o results.jsonl] [--workers 4]
+        每行一筆 {"id": ..., "budget": 70, "usage": "...", "brand": "..."}，結果依輸入順序輸出
+"""
+import argparse
+import json
+import sqlite3
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import core
+
+
+class RecommendHandler(BaseHTTPRequestHandler):
+    store = None
+    cache = None
+
+    def _send(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_metrics(self):
+        try: stats = core.advice_cache_stats()
+        except sqlite3.Error: stats = None
+        lines = [f"advice_cache_up {0 if stats is None else 1}"]
+        if stats is not None:
+            lines += [f"advice_cache_{name}_total {stats[name]}" for name in ('hits', 'misses', 'evictions')]
+            lines += [f"advice_cache_entries {stats['entries']}", f"advice_cache_hit_rate {stats['hit_rate']:.6f}"]
+        body = ('\n'.join(lines) + '\n').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _inventory(self):
+        df, status = self.store.refresh()
+        if status != "SUCCESS": self._send(503, {'error': f"庫存無法載入: {status}"})
+        return df if status == "SUCCESS" else None
+
+    def _answer(self, df, query):
+        response = core.run_query(df, query, self.cache)
+        if 'error' not in response: return response, 200
+        return response, 500 if response['error'].startswith(core.QUERY_FAILED) else 400
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/healthz':
+            df, status = self.store.refresh()
+            return self._send(200 if status == "SUCCESS" else 503, {'status': status, 'dataset_version': df.attrs.get('dataset_version'), 'rows': len(df), 'last_error': self.store.error})
+        if url.path == '/metrics': return self._send_metrics()
+        if url.path != '/recommend': return self._send(404, {'error': 'not found'})
+        df = self._inventory()
+        if df is None: return
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        response, status = self._answer(df, query)
+        self._send(status, response)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/recommend': return self._send(404, {'error': 'not found'})
+        try: payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+        except ValueError: return self._send(400, {'error': 'body 不是合法的 JSON'})
+        df = self._inventory()
+        if df is None: return
+        if isinstance(payload, list): return self._send(200, [self._answer(df, q)[0] for q in payload])
+        response, status = self._answer(df, payload)
+        self._send(status, response)
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"{self.address_string()} {format % args}\n")
+
+
+def serve(args):
+    RecommendHandler.store = core.InventoryStore(args.csv, args.snapshot)
+    RecommendHandler.cache = core.RecommendationCache()
+    df, status = RecommendHandler.store.refresh()
+    print(f"庫存 {status}: {len(df):,} 列，listening on http://{args.host}:{args.port}", file=sys.stderr)
+    ThreadingHTTPServer((args.host, args.port), RecommendHandler).serve_forever()
+
+
+def read_queries(path):
+    with (sys.stdin if path == '-' else open(path, encoding='utf-8')) as f:
+        for line in f:
+            if not line.strip(): continue
+            try: yield json.loads(line)
+            except ValueError: yield line  # run_query 會回報格式錯誤，輸出行數仍與輸入對齊
+
+
+def batch(args):
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        for response in core.run_queries(read_queries(args.input), args.csv, args.snapshot, args.workers, args.chunksize):
+            out.write(json.dumps(response, ensure_ascii=False) + '\n')
+    finally:
+        if out is not sys.stdout: out.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Brian's Auto Arbitrage 推薦 API / 批次查詢")
+    parser.add_argument("--csv", default=core.CSV_PATH)
+    parser.add_argument("--snapshot", default=core.SNAPSHOT_PATH)
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("serve", help="HTTP JSON 服務")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8080)
+    p.set_defaults(func=serve)
+    p = sub.add_parser("batch", help="JSONL 批次查詢")
+    p.add_argument("input", help="查詢 JSONL 檔 (- = stdin)")
+    p.add_argument("-o", "--output", default="-", help="結果 JSONL 檔 (預設 stdout)")
+    p.add_argument("--workers", type=int, default=None, help="process 數 (預設 CPU 核心數)")
+    p.add_argument("--chunksize", type=int, default=64)
+    p.set_defaults(func=batch)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,15 @@ import google.generativeai as genai
 import pandas as pd
 import os
 import random
+import threading
 import time
 from datetime import datetime
 
+from core import (
+    ADVICE_DB_PATH, ADVICE_FALLBACK, ALL_BRANDS, BUDGET_RANGE, CSV_PATH, NULL_TIMER, SNAPSHOT_PATH, USAGE_OPTIONS,
+    AdviceService, InventoryStore, RecommendationCache, SQLiteAdviceCache, StageTimer, similar_cars, warm_recommendations,
+)
+
 # ==========================================
 # 0. 核心設定
 # ==========================================
@@ -63,127 +69,56 @@ st.markdown("""
 # ==========================================
 # 1. 資料庫讀取
 # ==========================================
-@st.cache_data
+@st.cache_resource
+def get_inventory_store():
+    return InventoryStore(CSV_PATH, SNAPSHOT_PATH)
+
 def load_data():
-    csv_path = "cars.csv"
-    if not os.path.exists(csv_path): return pd.DataFrame(), "MISSING"
-    try: 
-        df = pd.read_csv(csv_path, on_bad_lines='skip')
-        if df.empty: return pd.DataFrame(), "EMPTY"
-        if '成本底價' in df.columns:
-             df['成本底價'] = df['成本底價'].astype(str).str.replace(',', '').str.replace('$', '').astype(float).astype(int)
-        df['車款名稱'] = df['車款名稱'].astype(str).str.strip().str.upper()
-        valid_brands = ['TOYOTA', 'HONDA', 'NISSAN', 'FORD', 'MAZDA', 'MITSUBISHI', 'LEXUS', 'BMW', 'BENZ', 'MERCEDES', 'VOLVO', 'AUDI', 'VOLKSWAGEN', 'VW', 'SUZUKI', 'SUBARU', 'HYUNDAI', 'KIA', 'PORSCHE', 'MINI', 'SKODA', 'PEUGEOT', 'INFINITI']
-        def extract_brand(name):
-            for brand in valid_brands:
-                if brand in name: 
-                    if brand == 'MERCEDES': return 'BENZ'
-                    if brand == 'VW': return 'VOLKSWAGEN'
-                    return brand
-            return 'OTHER'
-        df['Brand'] = df['車款名稱'].apply(extract_brand)
-        df = df[df['Brand'] != 'OTHER']
-        return df, "SUCCESS"
-    except Exception as e: return pd.DataFrame(), f"ERROR: {str(e)}"
+    # 所有 session 共用同一份唯讀庫存與索引；每次 rerun 只 stat 一次 cars.csv，有變動才增量匯入
+    return get_inventory_store().refresh()
 
 # ==========================================
 # 2. 推薦演算法
 # ==========================================
-def recommend_cars(df, budget_limit, usage, brand_pref):
-    budget_max = budget_limit * 10000
-    budget_min = budget_max * 0.3 
-    candidates = df[(df['成本底價'] <= budget_max) & (df['成本底價'] >= budget_min)].copy()
-    if candidates.empty: return pd.DataFrame()
-    
-    suv_keywords = ['CR-V', 'RAV4', 'KUGA', 'X-TRAIL', 'SUV', 'CX-5', 'ODYSSEY', 'GLC', 'RX', 'NX', 'TIGUAN', 'SPORTAGE', 'TUCSON', 'OUTLANDER', 'URX', 'SIENTA', 'CROSS', 'HR-V']
-    mpv_keywords = ['PREVIA', 'SIENNA', 'ALPHARD', 'ODYSSEY', 'M7', 'WISH', 'SHARAN', 'TOURAN', 'CARENS', 'HIACE']
-    toyota_sport = ['86', 'SUPRA', 'GR', 'AURIS', 'SPORT', 'CH-R']
-    
-    def calculate_match_score(row):
-        score = 0
-        name = row['車款名稱']
-        brand = row['Brand']
-        if usage == "極致省油代步":
-            if any(x in name for x in ['ALTIS', 'VIOS', 'YARIS', 'FIT', 'PRIUS', 'HYBRID', 'CITY', 'MARCH', 'COLT', 'SENTRA']): score += 50
-            elif any(x in name for x in suv_keywords + mpv_keywords): score -= 1000 
-        elif usage == "家庭舒適空間":
-            if any(x in name for x in mpv_keywords + suv_keywords): score += 50
-            elif any(x in name for x in ['YARIS', 'VIOS', 'MARCH', 'FIT', '86', 'MX-5']): score -= 1000 
-        elif usage == "業務通勤耐操":
-            if any(x in name for x in ['ALTIS', 'COROLLA', 'CAMRY', 'RAV4', 'CROSS', 'WISH']): score += 50
-        elif usage == "面子社交商務":
-            if any(x in name for x in ['BENZ', 'BMW', 'LEXUS', 'AUDI', 'VOLVO', 'PORSCHE']): score += 50
-            elif any(x in name for x in ['TOYOTA', 'HONDA', 'NISSAN']): score -= 10 
-        elif usage == "熱血操控樂趣":
-            if any(x in name for x in ['BMW', 'FOCUS', 'GOLF', 'MAZDA', 'MX-5', '86', 'WRX', 'COOPER', 'MUSTANG', 'ST', 'GTI', 'SUPRA', 'GR', 'AURIS']): score += 50
-            if any(x in name for x in mpv_keywords): score -= 10000
-            if any(x in name for x in ['RAV4', 'CR-V', 'X-TRAIL']): score -= 500 
-            if brand == "TOYOTA":
-                if any(x in name for x in toyota_sport): score += 20 
-                else: score -= 50 
-        elif usage == "新手練車 (高折舊)":
-            if any(x in name for x in ['VIOS', 'YARIS', 'COLT', 'TIIDA', 'MARCH', 'FOCUS', 'LIVINA']): score += 50
-        if brand_pref != "不限 (所有品牌)" and brand == brand_pref: score += 200 
-        return score
-
-    candidates['match_score'] = candidates.apply(calculate_match_score, axis=1)
-    candidates = candidates[candidates['match_score'] > -100]
-    candidates['預估市價'] = candidates['成本底價'] * 1.18 
-    candidates['代標總成本'] = candidates['成本底價'] * 1.05
-    candidates['潛在省錢'] = candidates['預估市價'] - candidates['代標總成本']
-    candidates = candidates.sort_values('成本底價', ascending=True)
-    candidates = candidates.drop_duplicates(subset=['車款名稱'], keep='first')
-
-    if candidates.empty: return pd.DataFrame()
-    final_list = []
-    used_brands = set() 
-    used_names = set() 
+RECOMMEND_WARMUP = os.environ.get("RECOMMEND_WARMUP", "0") == "1"
+SEARCH_DELAY = float(os.environ.get("SEARCH_DELAY", "0"))  # 搜尋時的展示用延遲 (秒)，預設關閉
 
-    if brand_pref != "不限 (所有品牌)":
-        hero_pool = candidates[(candidates['Brand'] == brand_pref) & (candidates['match_score'] > 0)].sort_values(['match_score', '潛在省錢'], ascending=[False, False])
-        if not hero_pool.empty:
-            hero_car = hero_pool.iloc[0]
-            hero_car['Role'] = '🏆 首選推薦' 
-            final_list.append(hero_car)
-            used_brands.add(hero_car['Brand'])
-            used_names.add(hero_car['車款名稱'])
+@st.cache_resource
+def get_recommendation_cache():
+    return RecommendationCache()
 
-    competitors_pool = candidates.sort_values(['match_score', '潛在省錢'], ascending=[False, False])
-    for idx, row in competitors_pool.iterrows():
-        if len(final_list) >= 3: break
-        if row['Brand'] not in used_brands and row['車款名稱'] not in used_names:
-            if len(final_list) == 0: row['Role'] = '💎 優質精選' 
-            elif len(final_list) == 1: row['Role'] = '⚔️ 強力競品'
-            else: row['Role'] = '⚖️ 跨界對比'
-            final_list.append(row)
-            used_brands.add(row['Brand'])
-            used_names.add(row['車款名稱'])
-
-    if len(final_list) < 3:
-        remaining_pool = candidates[~candidates['車款名稱'].isin(used_names)].sort_values(['match_score', '潛在省錢'], ascending=[False, False])
-        for idx, row in remaining_pool.iterrows():
-            if len(final_list) >= 3: break
-            row['Role'] = '🔥 熱門候補'
-            final_list.append(row)
-            used_names.add(row['車款名稱'])
-    return pd.DataFrame(final_list)
+@st.cache_resource(max_entries=1)
+def start_warmup(version):
+    # 每個資料版本只預熱一次
+    df, status = load_data()
+    if status != "SUCCESS" or df.attrs.get('dataset_version') != version: return None
+    thread = threading.Thread(target=warm_recommendations, args=(get_recommendation_cache(), df), name="recommend-warmup", daemon=True)
+    thread.start()
+    return thread
 
 # ==========================================
 # 3. AI 投資顧問
 # ==========================================
-def get_ai_advice(api_key, car_name, wholesale_price, market_price, savings):
+ADVICE_MODEL = 'gemini-1.5-flash'
+
+@st.cache_resource
+def get_advice_service(api_key):
     genai.configure(api_key=api_key)
-    try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        prompt = f"你是投資汽車顧問。標的：{car_name} (市價{int(market_price/10000)}萬 vs 底價{int(wholesale_price/10000)}萬)。請用60字內給出建議，Strong Buy。"
-        response = model.generate_content(prompt)
-        return response.text
-    except: return "AI 分析：數據顯示此車款目前位於折舊甜蜜點，拍場價格極具優勢。"
+    return AdviceService(genai.GenerativeModel(ADVICE_MODEL), cache=SQLiteAdviceCache(ADVICE_DB_PATH))
 
 # ==========================================
 # 4. 主程式 UI
 # ==========================================
+TIMING_PANEL = os.environ.get("TIMING_PANEL", "0") == "1"  # 側欄顯示本次 rerun 各階段耗時，部署前抓效能退步用
+
+def render_timing_panel(timer):
+    with st.sidebar.expander("⏱️ 各階段耗時 (本次 rerun)", expanded=True):
+        records = timer.records()
+        if records: st.dataframe(pd.DataFrame(records)[['stage', 'ms', 'calls']], hide_index=True)
+        st.caption(f"總計 {sum(r['ms'] for r in records if r['stage'] in ('load', 'recommend', 'advice', 'render')):.1f} ms；recommend 底下的細項只在快取未命中時出現")
+
 def main():
+    timer = StageTimer() if TIMING_PANEL else NULL_TIMER
     if 'search_clicked' not in st.session_state: st.session_state['search_clicked'] = False
     if 'results' not in st.session_state: st.session_state['results'] = pd.DataFrame()
 
@@ -293,51 +228,67 @@ def main():
     st.markdown("---")
     st.markdown("### 🔎 AI 全台庫存掃描")
     
-    df, status = load_data()
+    with timer.stage('load'): df, status = load_data()
+    if RECOMMEND_WARMUP and status == "SUCCESS": start_warmup(df.attrs['dataset_version'])
     if status == "SUCCESS" and not df.empty:
         brand_list = sorted(df['Brand'].unique().tolist())
-        brand_options = ["不限 (所有品牌)"] + brand_list
-    else: brand_options = ["不限 (所有品牌)"]
+        brand_options = [ALL_BRANDS] + brand_list
+    else: brand_options = [ALL_BRANDS]
 
     col1, col2, col3 = st.columns(3)
-    with col1: budget = st.slider("💰 總預算 (萬)", 10, 200, 70)
-    with col2: usage = st.selectbox("🎯 主要用途", ["極致省油代步", "家庭舒適空間", "業務通勤耐操", "面子社交商務", "熱血操控樂趣", "新手練車 (高折舊)"])
+    with col1: budget = st.slider("💰 總預算 (萬)", BUDGET_RANGE[0], BUDGET_RANGE[1], 70)
+    with col2: usage = st.selectbox("🎯 主要用途", USAGE_OPTIONS)
     with col3: brand = st.selectbox("🚗 優先品牌", brand_options)
 
     if st.button("🔍 啟動 AI 差異化對決"):
         if status != "SUCCESS": st.error("⚠️ 資料庫讀取失敗")
         else:
             with st.spinner("🤖 正在執行 TCO 財務模型分析..."):
-                time.sleep(1.0) 
-                results = recommend_cars(df, budget, usage, brand)
+                if SEARCH_DELAY: time.sleep(SEARCH_DELAY)
+                with timer.stage('recommend'): results = get_recommendation_cache().get(df, budget, usage, brand, timer=timer)
                 st.session_state['results'] = results
+                st.session_state['search_budget'] = budget  # 結果對應的預算；之後拉動滑桿不影響已顯示的結果
                 st.session_state['search_clicked'] = True
 
     if st.session_state['search_clicked']:
         results = st.session_state['results']
         if not results.empty:
             st.success(f"✅ AI 鎖定了 **{len(results)} 台** 最佳獲利標的。")
-            for i, (index, row) in enumerate(results.iterrows()):
-                car_name = row['車款名稱']
-                market_p = row['預估市價']
-                cost_p = row['成本底價']
-                savings = row['潛在省錢']
-                role = row.get('Role', '推薦標的')
-                role_bg = "#d32f2f" if "首選" in role else "#1976d2" if "競品" in role else "#616161"
-                with st.container():
-                    st.markdown(f"""<div class='card-box'>""", unsafe_allow_html=True)
-                    c_title, c_badge = st.columns([3, 1])
-                    with c_title: st.markdown(f"### {role}: {car_name}")
-                    with c_badge: st.markdown(f"<span class='role-tag' style='background-color:{role_bg}; float:right;'>{role}</span>", unsafe_allow_html=True)
-                    m1, m2, m3 = st.columns(3)
-                    m1.metric("市場行情", f"{int(market_p/10000)} 萬")
-                    m2.metric("拍場預估", f"{int(cost_p/10000)} 萬", delta="Wholesale", delta_color="inverse")
-                    m3.metric("Arbitrage", f"{int(savings/10000)} 萬", delta="Spread", delta_color="normal")
-                    if api_key:
-                        advice = get_ai_advice(api_key, car_name, cost_p, market_p, savings)
-                        st.markdown(f"<div style='background:#f9f9f9; padding:15px; border-left:5px solid {role_bg}; border-radius:5px; color:#333;'><b>🤖 AI 投資觀點：</b><br>{advice}</div>", unsafe_allow_html=True)
-                    st.markdown("</div>", unsafe_allow_html=True)
+            advices = []
+            if api_key:
+                cards = list(zip(results['車款名稱'], results['成本底價'], results['預估市價'], results['潛在省錢']))
+                with timer.stage('advice'):
+                    try: advices = get_advice_service(api_key).fetch_many(cards)
+                    except Exception: advices = [ADVICE_FALLBACK] * len(cards)
+            with timer.stage('render'):
+                for i, (index, row) in enumerate(results.iterrows()):
+                    car_name = row['車款名稱']
+                    market_p = row['預估市價']
+                    cost_p = row['成本底價']
+                    savings = row['潛在省錢']
+                    role = row.get('Role', '推薦標的')
+                    role_bg = "#d32f2f" if "首選" in role else "#1976d2" if "競品" in role else "#616161"
+                    with st.container():
+                        st.markdown(f"""<div class='card-box'>""", unsafe_allow_html=True)
+                        c_title, c_badge = st.columns([3, 1])
+                        with c_title: st.markdown(f"### {role}: {car_name}")
+                        with c_badge: st.markdown(f"<span class='role-tag' style='background-color:{role_bg}; float:right;'>{role}</span>", unsafe_allow_html=True)
+                        m1, m2, m3 = st.columns(3)
+                        m1.metric("市場行情", f"{int(market_p/10000)} 萬")
+                        m2.metric("拍場預估", f"{int(cost_p/10000)} 萬", delta="Wholesale", delta_color="inverse")
+                        m3.metric("Arbitrage", f"{int(savings/10000)} 萬", delta="Spread", delta_color="normal")
+                        if api_key:
+                            advice = advices[i]
+                            st.markdown(f"<div style='background:#f9f9f9; padding:15px; border-left:5px solid {role_bg}; border-radius:5px; color:#333;'><b>🤖 AI 投資觀點：</b><br>{advice}</div>", unsafe_allow_html=True)
+                        if i == 0:
+                            # 首選車的同級跨品牌替代：年份、價位、里程、車型、用途最接近的其他品牌
+                            with timer.stage('similar'): alternatives = similar_cars(df, results.iloc[[i]], max_price=st.session_state['search_budget'] * 10000)
+                            if not alternatives.empty:
+                                with st.expander("⚖️ 同級跨品牌替代"):
+                                    for _, alt in alternatives.iterrows(): st.markdown(f"- **{alt['車款名稱']}**：拍場 {int(alt['成本底價']/10000)} 萬 · 行情 {int(alt['預估市價']/10000)} 萬")
+                        st.markdown("</div>", unsafe_allow_html=True)
         else: st.warning(f"⚠️ 找不到符合條件的車。")
+    if TIMING_PANEL: render_timing_panel(timer)
 
     st.markdown("---")
     st.header("📝 自助委託結單 (Self-Service Kiosk)")
@@ -0,0 +1,501 @@
+"""效能基準測試：python bench.py {scoring,startup,query,brands,advice,pipeline,memory,pricing,similar} [--rows 1000000]
+
+pipeline：載入 → 推薦 → AI 建議逐段計時與記憶體峰值，結果存成 JSON，可用 --baseline 比對上一版：
+    python bench.py pipeline --output baseline.json
+    python bench.py pipeline --output after.json --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+import core
+
+
+def load_inventory():
+    df, status = core.read_inventory()
+    if status != "SUCCESS": raise SystemExit(f"cars.csv 載入失敗: {status}")
+    return df
+
+
+def synthetic_inventory(df, n_rows, seed=0):
+    # 從 cars.csv 抽樣車名，價格在原價 ±20% 內擾動
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(df), n_rows)
+    out = df.iloc[picks].reset_index(drop=True)
+    out['成本底價'] = (out['成本底價'].to_numpy() * rng.uniform(0.8, 1.2, n_rows)).astype(int)
+    return out
+
+
+def synthetic_raw(n_rows, seed=0):
+    # 依 cars.csv 的原始列抽樣 (含髒資料與非支援品牌)，底價在原價 ±20% 內擾動
+    raw = pd.read_csv(core.CSV_PATH, on_bad_lines='skip')
+    prices = pd.to_numeric(raw['成本底價'].astype(str).str.replace(',', '').str.replace('$', ''), errors='coerce')
+    raw, prices = raw[prices.notna()].reset_index(drop=True), prices[prices.notna()].to_numpy()
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(raw), n_rows)
+    out = raw.iloc[picks].reset_index(drop=True)
+    out['成本底價'] = (prices[picks] * rng.uniform(0.8, 1.2, n_rows)).astype(int)
+    return out
+
+
+def synthetic_csv(path, n_rows, seed=0):
+    synthetic_raw(n_rows, seed).to_csv(path, index=False)
+    return path
+
+
+def timed(fn, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+# 舊版逐列 apply 評分，僅供比對
+def legacy_match_score(candidates, usage, brand_pref):
+    suv_keywords = core.SUV_KEYWORDS
+    mpv_keywords = core.MPV_KEYWORDS
+    toyota_sport = ['86', 'SUPRA', 'GR', 'AURIS', 'SPORT', 'CH-R']
+
+    def calculate_match_score(row):
+        score = 0
+        name = row['車款名稱']
+        brand = row['Brand']
+        if usage == "極致省油代步":
+            if any(x in name for x in ['ALTIS', 'VIOS', 'YARIS', 'FIT', 'PRIUS', 'HYBRID', 'CITY', 'MARCH', 'COLT', 'SENTRA']): score += 50
+            elif any(x in name for x in suv_keywords + mpv_keywords): score -= 1000
+        elif usage == "家庭舒適空間":
+            if any(x in name for x in mpv_keywords + suv_keywords): score += 50
+            elif any(x in name for x in ['YARIS', 'VIOS', 'MARCH', 'FIT', '86', 'MX-5']): score -= 1000
+        elif usage == "業務通勤耐操":
+            if any(x in name for x in ['ALTIS', 'COROLLA', 'CAMRY', 'RAV4', 'CROSS', 'WISH']): score += 50
+        elif usage == "面子社交商務":
+            if any(x in name for x in ['BENZ', 'BMW', 'LEXUS', 'AUDI', 'VOLVO', 'PORSCHE']): score += 50
+            elif any(x in name for x in ['TOYOTA', 'HONDA', 'NISSAN']): score -= 10
+        elif usage == "熱血操控樂趣":
+            if any(x in name for x in ['BMW', 'FOCUS', 'GOLF', 'MAZDA', 'MX-5', '86', 'WRX', 'COOPER', 'MUSTANG', 'ST', 'GTI', 'SUPRA', 'GR', 'AURIS']): score += 50
+            if any(x in name for x in mpv_keywords): score -= 10000
+            if any(x in name for x in ['RAV4', 'CR-V', 'X-TRAIL']): score -= 500
+            if brand == "TOYOTA":
+                if any(x in name for x in toyota_sport): score += 20
+                else: score -= 50
+        elif usage == "新手練車 (高折舊)":
+            if any(x in name for x in ['VIOS', 'YARIS', 'COLT', 'TIIDA', 'MARCH', 'FOCUS', 'LIVINA']): score += 50
+        if brand_pref != "不限 (所有品牌)" and brand == brand_pref: score += 200
+        return score
+
+    return candidates.apply(calculate_match_score, axis=1).to_numpy()
+
+
+def bench_scoring(args):
+    base = load_inventory()
+    inventories = [("cars.csv", base)]
+    if args.rows: inventories.append((f"synthetic {args.rows:,}", core.add_keyword_flags(synthetic_inventory(base, args.rows))))
+    for label, df in inventories:
+        print(f"== {label} ({len(df):,} rows)")
+        for usage in core.USAGE_RULES:
+            for brand_pref in ["不限 (所有品牌)", "TOYOTA"]:
+                t_old, old = timed(legacy_match_score, df, usage, brand_pref, repeat=1)
+                t_new, new = timed(core.score_candidates, df, usage, brand_pref)
+                if not np.array_equal(old, new): raise SystemExit(f"評分不一致: {usage} / {brand_pref}")
+                print(f"{usage:<12} {brand_pref:<12} apply {t_old*1000:9.1f} ms  vector {t_new*1000:7.2f} ms  x{t_old/t_new:6.0f}")
+    # 排名比對：整條 recommend_cars 流程
+    for usage in core.USAGE_RULES:
+        for budget in (30, 80, 150):
+            for brand_pref in ["不限 (所有品牌)", "TOYOTA", "BMW"]:
+                new = core.recommend_cars(base, budget, usage, brand_pref)
+                orig = core.score_candidates
+                core.score_candidates = legacy_match_score
+                try: old = core.recommend_cars(base, budget, usage, brand_pref)
+                finally: core.score_candidates = orig
+                if not old.equals(new): raise SystemExit(f"推薦結果不一致: {usage} / {budget} / {brand_pref}")
+    print("✅ rankings identical")
+
+
+def bench_startup(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        cases = [("cars.csv", core.CSV_PATH)]
+        if args.rows:
+            cases.append((f"synthetic {args.rows:,}", synthetic_csv(os.path.join(tmp, "synthetic.csv"), args.rows)))
+        for label, csv_path in cases:
+            snapshot_path = os.path.join(tmp, os.path.basename(csv_path) + ".arrow")
+            t_build, _ = timed(core.build_snapshot, csv_path, snapshot_path, repeat=1)
+            t_csv, from_csv = timed(lambda: core.prepare_inventory(pd.read_csv(csv_path, on_bad_lines='skip')))
+            t_snap, from_snap = timed(core.read_snapshot, snapshot_path)
+            if not from_csv.equals(from_snap): raise SystemExit(f"快照內容與 CSV 不一致: {label}")
+            print(f"{label:<18} csv {t_csv*1000:9.1f} ms  snapshot {t_snap*1000:7.2f} ms  x{t_csv/t_snap:6.0f}  (build {t_build:.2f}s, {os.path.getsize(snapshot_path)/1e6:.1f} MB)")
+
+
+def bench_query(args):
+    # 走 recommend_cars 實際路徑：df.inventory 快取在 DataFrame 上 vs 每次查詢重建索引 (pandas 3 未快取 accessor 時的行為)
+    base = load_inventory()
+    n = len(PIPELINE_QUERIES)
+    for scale in args.scales:
+        df = base if scale == 1 else core.prepare_inventory(synthetic_raw(len(base) * scale))
+        if df.inventory is not df.inventory: raise SystemExit("df.inventory 沒有快取，每次存取都重建索引")
+        t_build, _ = timed(lambda: core.InventoryIndex(df), repeat=1)
+        t_cached, cached = timed(lambda: [core.recommend_cars(df, *q) for q in PIPELINE_QUERIES], repeat=5)
+        def rebuild_each():
+            out = []
+            for q in PIPELINE_QUERIES:
+                df.__dict__.pop('_inventory_accessor', None)
+                out.append(core.recommend_cars(df, *q))
+            return out
+        t_rebuild, rebuilt = timed(rebuild_each, repeat=1)
+        if not all(a.equals(b) for a, b in zip(cached, rebuilt)): raise SystemExit("推薦結果不一致")
+        print(f"{len(df):>10,} rows  recommend_cars cached index {t_cached/n*1000:7.2f} ms/query  rebuilt per query {t_rebuild/n*1000:8.2f} ms/query  (index build {t_build*1000:.0f} ms, {n} queries, results identical)")
+
+
+# 舊版品牌判斷 (依序 substring 比對)，僅供比對
+def legacy_extract_brand(name):
+    for brand in core.VALID_BRANDS:
+        if brand in name:
+            if brand == 'MERCEDES': return 'BENZ'
+            if brand == 'VW': return 'VOLKSWAGEN'
+            return brand
+    return 'OTHER'
+
+
+# cars.csv 實際車名 (含黏字、車系在前、別名) 與容易誤判的寫法
+BRAND_CASES = {
+    'TOYOTA RAV4 白 (2016)': ('TOYOTA', 'RAV4'),
+    'RAV4 TOYOTARAV4 (2015)': ('TOYOTA', 'RAV4'),
+    'PRIUS ALPHA TOYOTAPRIUSALPHA (2016)': ('TOYOTA', 'PRIUS'),
+    'IS200T LEXUSIS200T (2016)': ('LEXUS', 'IS200T'),
+    'LEXUS NX300H 深紅 (2014)': ('LEXUS', 'NX300H'),
+    'G63 MERCEDES-MG G63 (2016)': ('BENZ', 'G63'),
+    'BENZ GLC200 白 (2018)': ('BENZ', 'GLC200'),
+    'BMW 白 (2015)': ('BMW', None),
+    'COOPER MINI COOPER (2011)': ('MINI', 'COOPER'),
+    'MINI COOPER COUNTRYMAN (2017)': ('MINI', 'COOPER'),
+    'KIA K2500 白 (2018)': ('KIA', 'K2500'),
+    'EX37 INFINITI EX37 (2013)': ('INFINITI', 'EX37'),
+    'MAZDA CX-30 灰 (2019)': ('MAZDA', 'CX-30'),
+    'HONDA CR-V 黑 (2022)': ('HONDA', 'CR-V'),
+    'VW GOLF 白 (2015)': ('VOLKSWAGEN', 'GOLF'),
+    'MINICAB 白 (2015)': ('OTHER', None),
+    'SKIA 黑 (2015)': ('OTHER', None),
+    'MITSUBISHI MINI CAB 白 (2015)': ('MITSUBISHI', 'MINI'),
+}
+
+
+def bench_brands(args):
+    raw = pd.read_csv(core.CSV_PATH, on_bad_lines='skip')
+    names = raw['車款名稱'].astype(str).str.strip().str.upper()
+    inventories = [("cars.csv", names)]
+    if args.rows: inventories.append((f"synthetic {args.rows:,}", names.iloc[np.random.default_rng(0).integers(0, len(names), args.rows)].reset_index(drop=True)))
+    for label, series in inventories:
+        t_old, old = timed(lambda: series.apply(legacy_extract_brand), repeat=1)
+        t_new, new = timed(core.classify_names, series)
+        agree = (old.to_numpy() == new['Brand'].to_numpy()).mean()
+        print(f"{label:<18} loop {t_old*1000:9.1f} ms  compiled {t_new*1000:7.2f} ms  x{t_old/t_new:5.0f}  agreement {agree:.2%}")
+    cases = pd.Series(list(BRAND_CASES))
+    got = core.classify_names(cases)
+    wrong = [(name, expected, (brand, model if isinstance(model, str) else None)) for name, expected, brand, model in zip(cases, BRAND_CASES.values(), got['Brand'], got['model']) if expected != (brand, model if isinstance(model, str) else None)]
+    for name, expected, actual in wrong: print(f"❌ {name}: 預期 {expected}，得到 {actual}")
+    if wrong: raise SystemExit(f"{len(wrong)}/{len(cases)} 個品牌/車系判斷錯誤")
+    print(f"✅ {len(cases)} brand/model cases correct")
+
+
+class StubModel:
+    # 模擬 Gemini：固定延遲，回傳 prompt 內容
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    def generate_content(self, prompt):
+        self.calls += 1
+        time.sleep(self.latency)
+        return SimpleNamespace(text=f"stub: {prompt[:20]}")
+
+
+def _read_advice_cache(db_path, cards):
+    cache = core.SQLiteAdviceCache(db_path)
+    texts = [cache.get(core.AdviceService.cache_key(card[0], card[1])) for card in cards]
+    cache.flush()
+    return texts
+
+
+def bench_advice(args):
+    cards = [(f"CAR {i} (2020)", 300000 + i * 10000, 354000 + i * 11800, 39000 + i * 1300) for i in range(args.cards)]
+    model = StubModel(args.latency)
+    start = time.perf_counter()
+    for card in cards: model.generate_content(core.build_advice_prompt(*card))
+    t_serial = time.perf_counter() - start
+    service = core.AdviceService(model, max_workers=args.workers)
+    t_cold, _ = timed(service.fetch_many, cards, repeat=1)
+    t_warm, _ = timed(service.fetch_many, cards)
+    print(f"{args.cards} cards @ {args.latency*1000:.0f} ms: serial {t_serial*1000:7.1f} ms  concurrent {t_cold*1000:7.1f} ms  cached {t_warm*1000:6.3f} ms")
+    # 持久快取：第二個 service (模擬另一個 worker/副本) 應該全部命中
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "advice.sqlite3")
+        core.AdviceService(StubModel(args.latency), max_workers=args.workers, cache=core.SQLiteAdviceCache(db_path)).fetch_many(cards)
+        replica_model = StubModel(args.latency)
+        replica = core.AdviceService(replica_model, cache=core.SQLiteAdviceCache(db_path))
+        t_disk, _ = timed(replica.fetch_many, cards)
+        with ProcessPoolExecutor(4) as pool: list(pool.map(_read_advice_cache, [db_path] * 8, [cards] * 8))
+        if replica_model.calls: raise SystemExit("持久快取未命中")
+        print(f"sqlite cache {t_disk*1000:6.2f} ms  stats {replica.cache.stats()}")
+    # 逾時：回傳 fallback；排隊中的請求取消，已送出的跑完後寫進快取
+    slow_model = StubModel(args.latency * 3)
+    slow = core.AdviceService(slow_model, max_workers=1, timeout=args.latency)
+    batch = cards[:3]
+    if set(slow.fetch_many(batch)) != {core.ADVICE_FALLBACK}: raise SystemExit("逾時未回傳 fallback")
+    time.sleep(args.latency * 3)
+    if slow_model.calls != 1: raise SystemExit(f"逾時後排隊中的請求沒有取消 ({slow_model.calls} 次呼叫)")
+    if slow.fetch_many(batch[:1]) == [core.ADVICE_FALLBACK] or slow_model.calls != 1: raise SystemExit("晚到的建議沒有寫進快取")
+    print(f"✅ timeout falls back ({len(batch) - 1} queued requests cancelled, late answer cached)")
+
+
+PIPELINE_QUERIES = [(budget, usage, brand) for budget in (30, 70, 150) for usage in core.USAGE_OPTIONS for brand in (core.ALL_BRANDS, "TOYOTA")]
+
+
+def run_pipeline(csv_path, snapshot_path, timer, latency):
+    # 與 app.py 相同的流程；render 需要 Streamlit，改由 app 側欄的 TIMING_PANEL 量測
+    with timer.stage("csv_parse"): raw = pd.read_csv(csv_path, on_bad_lines='skip')
+    with timer.stage("prepare"): df = core.prepare_inventory(raw)
+    del raw
+    with timer.stage("price_fit"): model = core.PriceModel.fit(df)
+    with timer.stage("price_score"): core.add_market_prices(df, model)
+    with timer.stage("snapshot_load"): core.read_snapshot(snapshot_path)
+    with timer.stage("index"): df.inventory
+    with timer.stage("similar_index"): df.similar
+    results = [core.recommend_cars(df, budget, usage, brand, timer=timer) for budget, usage, brand in PIPELINE_QUERIES]
+    top = next((r for r in results if not r.empty), pd.DataFrame())
+    for (budget, _, _), r in zip(PIPELINE_QUERIES, results):
+        if r.empty: continue
+        with timer.stage("similar"): core.similar_cars(df, r.iloc[[0]], max_price=budget * 10000)
+    cards = list(zip(top['車款名稱'], top['成本底價'], top['預估市價'], top['潛在省錢'])) if not top.empty else []
+    with timer.stage("advice"): core.AdviceService(StubModel(latency)).fetch_many(cards)
+
+
+def bench_meta():
+    try: commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError): commit = None
+    import pyarrow
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "commit": commit, "python": sys.version.split()[0], "platform": platform.platform(),
+        "cpu_count": os.cpu_count(), "pandas": pd.__version__, "numpy": np.__version__, "pyarrow": pyarrow.__version__,
+    }
+
+
+def compare_results(results, baseline, tolerance):
+    # 同一規模、同一階段：耗時或記憶體峰值超過 baseline × tolerance (且差距超過雜訊門檻) 視為退步
+    base = {(size, r["stage"]): r for size, records in baseline["results"].items() for r in records}
+    regressions = []
+    print(f"== vs baseline {baseline['meta'].get('commit')} ({baseline['meta'].get('created')})")
+    for size, records in results["results"].items():
+        for r in records:
+            old = base.get((size, r["stage"]))
+            if old is None: continue
+            ratio = r["ms"] / old["ms"] if old["ms"] else float("inf")
+            slower = ratio > tolerance and r["ms"] - old["ms"] > 1.0
+            bigger = "peak_mb" in r and "peak_mb" in old and r["peak_mb"] > old["peak_mb"] * tolerance and r["peak_mb"] - old["peak_mb"] > 1.0
+            mark = "❌" if slower or bigger else "  "
+            mem = f"  peak {old['peak_mb']:8.1f} → {r['peak_mb']:8.1f} MB" if "peak_mb" in r and "peak_mb" in old else ""
+            print(f"{mark} {int(size):>10,} {r['stage']:<14} {old['ms']:10.1f} → {r['ms']:10.1f} ms  x{ratio:5.2f}{mem}")
+            if slower or bigger: regressions.append((size, r["stage"]))
+    if regressions: raise SystemExit(f"{len(regressions)} 個階段退步超過 {tolerance - 1:.0%}: {regressions}")
+    print("✅ no regressions")
+
+
+def bench_pipeline(args):
+    results = {"meta": {**bench_meta(), "repeat": args.repeat, "latency": args.latency, "queries": len(PIPELINE_QUERIES)}, "results": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            csv_path = synthetic_csv(os.path.join(tmp, f"cars_{size}.csv"), size)
+            snapshot_path = csv_path + ".arrow"
+            core.build_snapshot(csv_path, snapshot_path)
+            timers = []
+            for _ in range(args.repeat):
+                timers.append(core.StageTimer())
+                run_pipeline(csv_path, snapshot_path, timers[-1], args.latency)
+            # 每段取多次中最快的一次；記憶體峰值另外跑一次 (tracemalloc 會拖慢計時)
+            records = [{**r, "ms": min(t.seconds[r["stage"]] for t in timers) * 1000} for r in timers[0].records()]
+            if args.memory:
+                mem = core.StageTimer(trace_memory=True)
+                run_pipeline(csv_path, snapshot_path, mem, args.latency)
+                peaks = {r["stage"]: r["peak_mb"] for r in mem.records()}
+                records = [{**r, "peak_mb": peaks[r["stage"]]} for r in records]
+            results["results"][str(size)] = [{**r, "ms": round(r["ms"], 3)} for r in records]
+            print(f"== synthetic {size:,} rows ({os.path.getsize(csv_path) / 1e6:.1f} MB csv)")
+            for r in records:
+                per_call = f"  ({r['ms'] / r['calls']:8.3f} ms × {r['calls']})" if r["calls"] > 1 else ""
+                peak = f"  peak {r['peak_mb']:8.1f} MB" if "peak_mb" in r else ""
+                print(f"  {r['stage']:<14} {r['ms']:10.1f} ms{per_call}{peak}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f: compare_results(results, json.load(f), args.tolerance)
+
+
+# 原始 app.py load_data 的欄位型別：object 字串、float → int64 底價、保留原始備註，僅供比對
+def legacy_load(csv_path):
+    df = pd.read_csv(csv_path, on_bad_lines='skip', dtype=object)
+    df['成本底價'] = df['成本底價'].astype(str).str.replace(',', '').str.replace('$', '').astype(float).astype(int)
+    df['車款名稱'] = df['車款名稱'].astype(str).str.strip().str.upper().astype(object)
+    df['Brand'] = df['車款名稱'].map(legacy_extract_brand).astype(object)
+    return df[df['Brand'] != 'OTHER']
+
+
+# 上一版 recommend_cars：每次查詢對候選切片做 assign / 布林遮罩 / drop_duplicates，各自複製一份，僅供比對
+def copying_recommend(df, budget_limit, usage, brand_pref, top_n=core.RECOMMEND_TOP_N):
+    budget_max = budget_limit * 10000
+    candidates = df.inventory.budget_slice(budget_max * 0.3, budget_max)
+    if candidates.empty: return pd.DataFrame()
+    candidates = candidates.assign(match_score=core.score_candidates(candidates, usage, brand_pref))
+    candidates = candidates[candidates['match_score'] > -100].assign(代標總成本=lambda c: c['成本底價'] * core.AUCTION_FEE_RATE)
+    candidates = candidates.assign(潛在省錢=candidates['預估市價'] - candidates['代標總成本'])
+    candidates = candidates.drop_duplicates(subset=['車款名稱'], keep='first')
+    if candidates.empty: return pd.DataFrame()
+    positions, roles = core.select_diverse(candidates['Brand'].to_numpy(), candidates['match_score'].to_numpy(), candidates['潛在省錢'].to_numpy(), brand_pref, top_n)
+    rows = candidates.iloc[positions]
+    return rows.assign(**core.plain_strings(rows), Role=roles)
+
+
+def bench_memory(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        cases = [("cars.csv", core.CSV_PATH)]
+        if args.rows: cases.append((f"synthetic {args.rows:,}", synthetic_csv(os.path.join(tmp, "synthetic.csv"), args.rows)))
+        for label, csv_path in cases:
+            before = legacy_load(csv_path)
+            after = core.prepare_inventory(pd.read_csv(csv_path, on_bad_lines='skip'))
+            core.add_market_prices(after, core.PriceModel.fit(after))
+            mem_before, mem_after = before.memory_usage(deep=True, index=False), after.memory_usage(deep=True, index=False)
+            print(f"== {label}: {len(before):,} rows  before {mem_before.sum() / len(before):7.1f} B/row  after {mem_after.sum() / len(after):7.1f} B/row  x{(mem_before.sum() / len(before)) / (mem_after.sum() / len(after)):4.1f}")
+            for col in dict.fromkeys(list(mem_before.index) + list(mem_after.index)):
+                b = f"{mem_before[col] / len(before):7.1f} {str(before[col].dtype):<10}" if col in mem_before else " " * 18
+                a = f"{mem_after[col] / len(after):7.1f} {str(after[col].dtype)}" if col in mem_after else "-"
+                print(f"   {col:<16} {b} → {a}")
+            # 每次查詢的額外配置：舊版複製候選切片 vs 共用切片只取入選列
+            timer = core.StageTimer(trace_memory=True)
+            for budget, usage, brand in PIPELINE_QUERIES:
+                with timer.stage("copying"): old = copying_recommend(after, budget, usage, brand)
+                with timer.stage("shared"): new = core.recommend_cars(after, budget, usage, brand)
+                if not old.equals(new): raise SystemExit(f"推薦結果不一致: {budget} / {usage} / {brand}")
+            peaks = {r["stage"]: r for r in timer.records()}
+            print(f"   per-query peak alloc  copying {peaks['copying']['peak_mb'] * 1000:8.1f} KB  shared {peaks['shared']['peak_mb'] * 1000:8.1f} KB  ({len(PIPELINE_QUERIES)} queries, results identical)")
+
+
+def bench_pricing(args):
+    for size in args.sizes:
+        df = core.prepare_inventory(synthetic_raw(size))
+        t_fit, model = timed(core.PriceModel.fit, df, repeat=1)
+        t_score, _ = timed(core.add_market_prices, df, model)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "price_model.json")
+            t_save, _ = timed(model.save, path, repeat=1)
+            t_load, loaded = timed(core.PriceModel.load, path)
+            if not np.allclose(loaded.predict(df), model.predict(df)): raise SystemExit("存檔後估價不一致")
+            size_kb = os.path.getsize(path) / 1000
+        # 留 20% 驗證：行情模型 vs 只看品牌中位數，比 log 底價的誤差 (排除底價 == 里程的列)
+        rng = np.random.default_rng(0)
+        test = rng.random(len(df)) < 0.2
+        train, held = df[~test].reset_index(drop=True), df[test].reset_index(drop=True)
+        held = held[held['成本底價'].to_numpy() != held['mileage_km'].to_numpy(dtype='float64', na_value=np.nan)]
+        actual = np.log(held['成本底價'].to_numpy(dtype='float64'))
+        err_model = np.median(np.abs(np.log(core.PriceModel.fit(train).predict(held)) - actual))
+        brand_median = np.log(train['成本底價'].astype('float64')).groupby(train['Brand'].astype(object).to_numpy()).median()
+        err_brand = np.median(np.abs(brand_median.reindex(held['Brand'].astype(object).to_numpy()).to_numpy() - actual))
+        # 查詢延遲：讀預先算好的欄位 vs 每次查詢乘固定倍數
+        legacy = df.drop(columns='預估市價')
+        t_query, _ = timed(lambda: [core.recommend_cars(df, *q) for q in PIPELINE_QUERIES])
+        t_legacy, _ = timed(lambda: [core.recommend_cars(legacy, *q) for q in PIPELINE_QUERIES])
+        n = len(PIPELINE_QUERIES)
+        print(f"{len(df):>10,} rows  fit {t_fit*1000:8.1f} ms  score {t_score*1000:7.1f} ms  save {t_save*1000:6.1f} ms  load {t_load*1000:6.1f} ms ({size_kb:.0f} KB)"
+              f"  holdout |log err| model {err_model:.3f} vs brand median {err_brand:.3f}  query {t_query/n*1000:.2f} ms (fixed x1.18 {t_legacy/n*1000:.2f} ms)")
+
+
+# 暴力最近鄰：對全部列算距離，僅供比對
+def brute_force_similar(index, vector, brand, k, max_price):
+    ok = index.brand_codes != index.brand_lookup.get(brand, -2)
+    if max_price is not None: ok &= index.prices <= max_price
+    found = np.flatnonzero(ok)
+    distances = np.sqrt(((index.features[found] - vector) ** 2).sum(axis=1))
+    order = np.lexsort((index.rows[found], distances))
+    _, first = np.unique(index.name_codes[found[order]], return_index=True)
+    keep = order[np.sort(first)][:k]
+    return index.rows[found[keep]], distances[keep]
+
+
+def bench_similar(args):
+    rng = np.random.default_rng(1)
+    for size in args.sizes:
+        df = core.prepare_inventory(synthetic_raw(size))
+        core.add_market_prices(df, core.PriceModel.fit(df))
+        t_build, index = timed(core.SimilarityIndex, df, repeat=1)
+        object.__setattr__(df, '_similar_accessor', index)
+        heroes = rng.integers(0, len(df), args.queries)
+        latencies, t_brute = [], 0.0
+        for pos in heroes:
+            car = df.iloc[[pos]]
+            max_price = int(car['成本底價'].iloc[0] * 1.3)
+            start = time.perf_counter()
+            got = core.similar_cars(df, car, args.k, max_price)
+            latencies.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            want, _ = brute_force_similar(index, index.vector_of(car), car['Brand'].iloc[0], args.k, max_price)
+            t_brute += time.perf_counter() - start
+            if not np.array_equal(df.index.get_indexer(got.index), want): raise SystemExit(f"最近鄰與暴力搜尋不一致: {car['車款名稱'].iloc[0]}")
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        print(f"{len(df):>10,} rows  build {t_build*1000:7.1f} ms  similar_cars p50 {p50:6.2f} ms  p99 {p99:6.2f} ms  brute force {t_brute/len(heroes)*1000:7.2f} ms  ({len(heroes)} queries, identical)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Brian's Auto Arbitrage benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("scoring", help="apply vs 向量化評分")
+    p.add_argument("--rows", type=int, default=1_000_000, help="合成庫存列數 (0 = 只測 cars.csv)")
+    p.set_defaults(func=bench_scoring)
+    p = sub.add_parser("startup", help="CSV 解析 vs Arrow 快照載入")
+    p.add_argument("--rows", type=int, default=1_000_000, help="合成庫存列數 (0 = 只測 cars.csv)")
+    p.set_defaults(func=bench_startup)
+    p = sub.add_parser("query", help="recommend_cars 延遲：快取底價索引 vs 每次查詢重建")
+    p.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100], help="cars.csv 的倍數")
+    p.set_defaults(func=bench_query)
+    p = sub.add_parser("brands", help="逐品牌 substring 迴圈 vs 編譯 regex 品牌/車系判斷")
+    p.add_argument("--rows", type=int, default=1_000_000, help="合成車名列數 (0 = 只測 cars.csv)")
+    p.set_defaults(func=bench_brands)
+    p = sub.add_parser("advice", help="逐張 vs 並行 AI 建議 (stub model)")
+    p.add_argument("--cards", type=int, default=3)
+    p.add_argument("--workers", type=int, default=core.ADVICE_MAX_WORKERS)
+    p.add_argument("--latency", type=float, default=0.8, help="stub 每次呼叫延遲 (秒)")
+    p.set_defaults(func=bench_advice)
+    p = sub.add_parser("pipeline", help="載入 → 推薦 → AI 建議 逐段計時、記憶體峰值與 baseline 比對")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="合成庫存列數")
+    p.add_argument("--repeat", type=int, default=3, help="每個規模跑幾次，各階段取最快")
+    p.add_argument("--latency", type=float, default=0.05, help="stub 每次呼叫延遲 (秒)")
+    p.add_argument("--no-memory", dest="memory", action="store_false", help="不跑 tracemalloc 記憶體量測")
+    p.add_argument("--output", default="bench_results.json", help="結果 JSON 路徑 (空字串 = 不寫檔)")
+    p.add_argument("--baseline", help="上一版的結果 JSON，用來比對退步")
+    p.add_argument("--tolerance", type=float, default=1.25, help="超過 baseline 幾倍算退步")
+    p.set_defaults(func=bench_pipeline)
+    p = sub.add_parser("memory", help="原始 vs 精簡欄位型別的每列記憶體，與每次查詢的額外配置")
+    p.add_argument("--rows", type=int, default=0, help="另測合成庫存列數 (0 = 只測 cars.csv)")
+    p.set_defaults(func=bench_memory)
+    p = sub.add_parser("pricing", help="行情模型擬合 / 估價 / 存讀耗時、驗證誤差與查詢延遲")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="合成庫存列數")
+    p.set_defaults(func=bench_pricing)
+    p = sub.add_parser("similar", help="相似車款網格索引 vs 暴力最近鄰")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="合成庫存列數")
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("-k", type=int, default=core.SIMILAR_TOP_K)
+    p.set_defaults(func=bench_similar)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+"""預編譯庫存快照：python build_snapshot.py [cars.csv] [cars.arrow]
+
+cars.csv 每次更新後執行一次；load_data 會在快照比 CSV 新時直接 memory-map 載入。
+"""
+import sys
+import time
+
+import core
+
+
+def main():
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else core.CSV_PATH
+    snapshot_path = sys.argv[2] if len(sys.argv) > 2 else core.SNAPSHOT_PATH
+    start = time.perf_counter()
+    df = core.build_snapshot(csv_path, snapshot_path)
+    print(f"✅ {snapshot_path}: {len(df):,} 列, {time.perf_counter() - start:.2f}s")
+    failures = {field: n for field, n in df.attrs.get('parse_failures', {}).items() if n}
+    if failures: print(f"⚠️ 解析失敗: {failures}")
+
+
+if __name__ == "__main__":
+    main()
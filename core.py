@@ -0,0 +1,999 @@
+"""Brian's Auto Arbitrage 核心：庫存載入、推薦演算法、AI 建議服務。
+
+不 import streamlit，可給 app.py (Streamlit UI)、api.py (HTTP / 批次) 與 bench.py 共用。
+"""
+import hashlib
+import io
+import json
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+# ==========================================
+# 1. 資料庫讀取
+# ==========================================
+CSV_PATH = "cars.csv"
+SNAPSHOT_PATH = "cars.arrow"
+SNAPSHOT_VERSION = 6  # prepare_inventory 欄位有變動就 +1，舊快照會自動改走 CSV
+VALID_BRANDS = ['TOYOTA', 'HONDA', 'NISSAN', 'FORD', 'MAZDA', 'MITSUBISHI', 'LEXUS', 'BMW', 'BENZ', 'MERCEDES', 'VOLVO', 'AUDI', 'VOLKSWAGEN', 'VW', 'SUZUKI', 'SUBARU', 'HYUNDAI', 'KIA', 'PORSCHE', 'MINI', 'SKODA', 'PEUGEOT', 'INFINITI']
+
+BRAND_ALIASES = {'MERCEDES': 'BENZ', 'VW': 'VOLKSWAGEN'}
+AMBIGUOUS_BRANDS = {'MINI', 'VW', 'KIA'}  # 太短、容易出現在其他字裡，必須是完整的字
+
+_BRAND_ALTERNATION = '|'.join(re.escape(b) for b in sorted(VALID_BRANDS, key=len, reverse=True))
+
+def _brand_alternative(brand):
+    return re.escape(brand) + ('(?![A-Z0-9])' if brand in AMBIGUOUS_BRANDS else '')
+
+# 品牌必須出現在字首 (允許 TOYOTARAV4、LEXUSIS200T 這類黏在一起的寫法)，取最左邊的一個
+BRAND_PATTERN = re.compile('(?<![A-Z0-9])(?P<brand>' + '|'.join(_brand_alternative(b) for b in sorted(VALID_BRANDS, key=len, reverse=True)) + ')')
+# 車系：品牌在前取品牌後第一個英數字 (BENZ A180、TOYOTARAV4)，否則取開頭的英數字 (RAV4 TOYOTARAV4)；「BMW 白」這種沒有車系
+MODEL_PATTERN = re.compile('^(?:(?:' + _BRAND_ALTERNATION + ')[\\s-]*|(?!' + _BRAND_ALTERNATION + '))(?P<model>[A-Z0-9][A-Z0-9\\-]*)')
+
+def classify_names(names):
+    # 只對不重複的車名跑 regex，再展開回每一列
+    codes, uniques = pd.factorize(names)
+    uniques = pd.Series(uniques, dtype=object)
+    brands = uniques.str.extract(BRAND_PATTERN)['brand'].replace(BRAND_ALIASES).fillna('OTHER')
+    models = uniques.str.extract(MODEL_PATTERN)['model'].where(brands != 'OTHER')
+    return pd.DataFrame({'Brand': brands.to_numpy()[codes], 'model': models.to_numpy()[codes]}, index=names.index)
+
+# 備註格式：「里程: 140,493km, 評價: B+, 來源: PDF」；年份在車款名稱尾端「(2012)」
+NOTES_PATTERN = re.compile(r'^\s*里程:\s*(?:(?P<mileage_km>[\d,]+)\s*km|Unknown)\s*,\s*評價:\s*(?P<grade>[A-Z][+-]?)?\s*,\s*來源:\s*(?P<source>.*?)\s*$', re.IGNORECASE)
+YEAR_PATTERN = re.compile(r'\((?P<year>(?:19|20)\d{2})\)\s*$')
+
+def parse_notes(df):
+    # 向量化解析：str.extract 一次抽出所有欄位，不跑逐列 Python
+    notes = df.get('備註', pd.Series('', index=df.index)).astype(str).str.extract(NOTES_PATTERN)
+    years = df['車款名稱'].str.extract(YEAR_PATTERN)['year']
+    df['year'] = pd.to_numeric(years).astype('Int16')
+    df['mileage_km'] = pd.to_numeric(notes['mileage_km'].str.replace(',', '')).astype('Int32')
+    df['grade'] = notes['grade'].str.upper().astype('category')
+    df['source'] = notes['source'].astype('category')
+    df.attrs['parse_failures'] = parse_failures(df)
+    return df
+
+def parse_failures(df):
+    # source 為空 = 備註整段對不上格式；year 為空 = 車款名稱沒有 (YYYY)
+    return {'備註': int(df['source'].isna().sum()), 'year': int(df['year'].isna().sum())}
+
+def hash_rows(raw):
+    # 原始列內容的 64-bit 雜湊：增量匯入用來判斷哪些列沒變、可沿用已清洗的結果
+    return pd.util.hash_pandas_object(raw[[c for c in raw.columns if c != '_pos']].astype(str), index=False).to_numpy()
+
+PRICE_DTYPE = np.int32  # 底價 (元) 上限約 21 億，int32 足夠
+CATEGORY_COLUMNS = ['車款名稱', 'Brand', 'model', 'grade', 'source']  # 重複值多的字串欄位一律存成 category (車名等於 intern 過)
+
+def prepare_inventory(df):
+    # 原始 CSV → 清洗後庫存 (CSV 路徑、快照建置與增量匯入共用)
+    if 'row_hash' not in df.columns: df['row_hash'] = hash_rows(df)
+    if '成本底價' in df.columns:
+        prices = df['成本底價']
+        if not pd.api.types.is_numeric_dtype(prices): prices = pd.to_numeric(prices.astype(str).str.replace(',', '').str.replace('$', ''))
+        df['成本底價'] = prices.astype(PRICE_DTYPE)
+    df['車款名稱'] = df['車款名稱'].astype(str).str.strip().str.upper()
+    df[['Brand', 'model']] = classify_names(df['車款名稱'])
+    df = df[df['Brand'] != 'OTHER'].reset_index(drop=True)
+    df = add_keyword_flags(df)
+    df = parse_notes(df).drop(columns='備註', errors='ignore')  # 已解析成 mileage_km / grade / source，不留原始字串
+    df[CATEGORY_COLUMNS] = df[CATEGORY_COLUMNS].astype('category')
+    # 依底價穩定排序：預算查詢可直接 searchsorted 切片 (見 InventoryIndex)
+    df = df.sort_values('成本底價', kind='stable').reset_index(drop=True)
+    df.attrs['snapshot_version'] = SNAPSHOT_VERSION
+    return df
+
+def snapshot_is_fresh(csv_path=CSV_PATH, snapshot_path=SNAPSHOT_PATH):
+    return os.path.exists(snapshot_path) and os.path.getmtime(snapshot_path) >= os.path.getmtime(csv_path)
+
+def build_snapshot(csv_path=CSV_PATH, snapshot_path=SNAPSHOT_PATH):
+    # 一次性預編譯：未壓縮的 Arrow IPC 檔，讀取時可直接 memory-map
+    df = prepare_inventory(pd.read_csv(csv_path, on_bad_lines='skip'))
+    tmp_path = snapshot_path + ".tmp"
+    df.to_feather(tmp_path, compression='uncompressed')
+    os.replace(tmp_path, snapshot_path)
+    return df
+
+def read_snapshot(snapshot_path=SNAPSHOT_PATH):
+    # split_blocks：數值欄位直接指向 memory-map 的緩衝區，不另外複製
+    return feather.read_table(snapshot_path, memory_map=True).to_pandas(split_blocks=True)
+
+def register_cached_accessor(name):
+    # 同 pd.api.extensions.register_dataframe_accessor，但建好的物件快取在該 DataFrame 上
+    # (pandas 3 起 accessor 每次存取都重新建立；索引類 accessor 必須自己快取，複本與切片不會帶著快取)
+    def register(cls):
+        slot = f'_{name}_accessor'
+        def get(df):
+            obj = df.__dict__.get(slot)
+            if obj is None:
+                obj = cls(df)
+                object.__setattr__(df, slot, obj)
+            return obj
+        setattr(pd.DataFrame, name, property(get, doc=cls.__doc__))
+        return cls
+    return register
+
+@register_cached_accessor("inventory")
+class InventoryIndex:
+    """底價索引：df.inventory 第一次存取時建立，之後快取在同一個 DataFrame 物件上。
+
+    列依底價排序 (prepare_inventory 已排好則不複製)，預算查詢用 searchsorted 取連續切片 (view，不複製)。
+    品牌偏好只影響評分與主打車挑選，在切片上以陣列處理，不另建品牌索引。
+    """
+    def __init__(self, df):
+        prices = df['成本底價'].to_numpy()
+        if len(prices) > 1 and (prices[1:] < prices[:-1]).any():
+            df = df.iloc[np.argsort(prices, kind='stable')]
+            prices = df['成本底價'].to_numpy()
+        self.frame, self.prices = df, prices
+
+    def budget_slice(self, price_min, price_max):
+        lo = np.searchsorted(self.prices, price_min, side='left')
+        hi = np.searchsorted(self.prices, price_max, side='right')
+        return self.frame.iloc[lo:hi]
+
+CSV_CHUNK_ROWS = 200_000  # 大型拍場匯出檔分批讀取
+
+def file_digest(path, limit=None):
+    # 檔案內容雜湊 (前 limit bytes)，作為資料版本與「前段沒被改過」的判斷依據
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        remaining = limit
+        while remaining is None or remaining > 0:
+            block = f.read(1 << 20 if remaining is None else min(1 << 20, remaining))
+            if not block: break
+            digest.update(block)
+            if remaining is not None: remaining -= len(block)
+    return digest
+
+class FileRange(io.RawIOBase):
+    """檔案的 [start, end) 區段，當成檔案交給 read_csv(chunksize=...) 分批串流，不整段讀進記憶體。"""
+    def __init__(self, path, start, end):
+        self._f = open(path, 'rb')
+        self._f.seek(start)
+        self._remaining = end - start
+
+    def readable(self): return True
+
+    def readinto(self, buffer):
+        n = self._f.readinto(memoryview(buffer)[:min(len(buffer), self._remaining)]) if self._remaining > 0 else 0
+        self._remaining -= n
+        return n
+
+    def close(self):
+        self._f.close()
+        super().close()
+
+def dataset_version(csv_path=CSV_PATH):
+    # 以 cars.csv 內容雜湊當版本，下游快取 (推薦結果等) 以此為 key
+    if not os.path.exists(csv_path): return "missing"
+    return file_digest(csv_path).hexdigest()
+
+def read_inventory(csv_path=CSV_PATH, snapshot_path=SNAPSHOT_PATH):
+    if not os.path.exists(csv_path): return pd.DataFrame(), "MISSING"
+    try: 
+        df = read_snapshot(snapshot_path) if snapshot_is_fresh(csv_path, snapshot_path) else None
+        if df is None or df.attrs.get('snapshot_version') != SNAPSHOT_VERSION:
+            df = pd.read_csv(csv_path, on_bad_lines='skip')
+            if df.empty: return pd.DataFrame(), "EMPTY"
+            df = prepare_inventory(df)
+        df.attrs['dataset_version'] = dataset_version(csv_path)
+        price_inventory(df)
+        df.inventory  # 預先建立底價索引
+        df.similar    # 與相似車款索引
+        return df, "SUCCESS"
+    except Exception as e: return pd.DataFrame(), f"ERROR: {str(e)}"
+
+def merge_inventory(parts):
+    # 合併已清洗的片段：依 CSV 位置 (_pos) 再依底價穩定排序，與整檔重建結果一致
+    df = pd.concat([p for p in parts if not p.empty], ignore_index=True)
+    df = df.iloc[np.lexsort((df['_pos'].to_numpy(), df['成本底價'].to_numpy()))].drop(columns='_pos').reset_index(drop=True)
+    for col in CATEGORY_COLUMNS: df[col] = df[col].astype('category').cat.remove_unused_categories()
+    df.attrs = {'snapshot_version': SNAPSHOT_VERSION, 'parse_failures': parse_failures(df)}
+    return df
+
+class InventoryStore:
+    """常駐記憶體的庫存：cars.csv 有變動時只處理新增或改動的列。
+
+    - 只在檔尾追加：比對已處理前段的內容雜湊後，只 parse 新增的 bytes (還沒寫完的半行留到下次)。
+    - 前段被改寫：分批重讀全檔，但只有雜湊沒見過的列才重新清洗，其餘沿用。
+    每次變動都會換一個 dataset_version (內容雜湊)，推薦快取等下游以此失效。
+    """
+    def __init__(self, csv_path=CSV_PATH, snapshot_path=SNAPSHOT_PATH):
+        self.csv_path, self.snapshot_path = csv_path, snapshot_path
+        self.df, self.status = pd.DataFrame(), "MISSING"
+        self.columns = None
+        self.stat, self.offset, self.digest = None, 0, None
+        self.clean_end = True  # 已處理的部分是否以換行結尾；不是的話最後一列可能還會被接著寫，不能走追加
+        self.error = None      # 最近一次載入失敗的原因 (仍在用上一份好的庫存時)
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        if not os.path.exists(self.csv_path): return pd.DataFrame(), "MISSING"
+        st_ = os.stat(self.csv_path)
+        stat = (st_.st_mtime_ns, st_.st_size)
+        if stat == self.stat: return self.df, self.status
+        with self._lock:
+            if stat != self.stat:
+                previous = self.df
+                try:
+                    self._ingest(stat)
+                    self.error = None
+                except Exception as e:
+                    # 繼續用上一份好的庫存；雜湊歸零，下次一律整檔重讀，不在失敗的狀態上接著追加
+                    self.stat, self.digest, self.error = None, None, f"ERROR: {str(e)}"
+                    if self.status == "SUCCESS": self.df = previous
+                    else: self.df, self.status = pd.DataFrame(), self.error
+        return self.df, self.status
+
+    def _ingest(self, stat):
+        size = stat[1]
+        appended = self.digest is not None and self.clean_end and size > self.offset and file_digest(self.csv_path, self.offset).digest() == self.digest.digest()
+        if appended: self._ingest_tail(size)
+        elif self.digest is None and snapshot_is_fresh(self.csv_path, self.snapshot_path): self._ingest_snapshot(size)
+        else: self._ingest_full(size)
+        self.stat = stat
+        if self.df.empty: self.status = "EMPTY"
+        else:
+            self.df.attrs['dataset_version'] = self.digest.hexdigest()
+            price_inventory(self.df)  # 資料變了，行情表跟著重擬合
+            self.df.inventory  # 新的 DataFrame 物件，重建底價索引
+            self.df.similar
+            self.status = "SUCCESS"
+
+    def _ends_with_newline(self, size):
+        if not size: return True
+        with open(self.csv_path, 'rb') as f:
+            f.seek(size - 1)
+            return f.read(1) == b'\n'
+
+    def _complete_end(self, start, size):
+        # 追加用：從檔尾往回找最後一個換行，只處理到那裡，還沒寫完的半行留到下次
+        with open(self.csv_path, 'rb') as f:
+            end = size
+            while end > start:
+                block_start = max(start, end - (1 << 16))
+                f.seek(block_start)
+                i = f.read(end - block_start).rfind(b'\n')
+                if i >= 0: return block_start + i + 1
+                end = block_start
+        return start
+
+    def _ingest_tail(self, size):
+        data_end = self._complete_end(self.offset, size)
+        if data_end == self.offset: return
+        parts = [self.df.assign(_pos=np.arange(len(self.df)))]  # 舊列都排在新列之前，維持 CSV 順序
+        pos = len(self.df)
+        with io.BufferedReader(FileRange(self.csv_path, self.offset, data_end)) as f:
+            for chunk in pd.read_csv(f, header=None, names=self.columns, on_bad_lines='skip', chunksize=CSV_CHUNK_ROWS):
+                chunk['_pos'] = np.arange(len(chunk)) + pos
+                pos += len(chunk)
+                parts.append(prepare_inventory(chunk))
+        self.df = merge_inventory(parts)
+        with FileRange(self.csv_path, self.offset, data_end) as f:
+            for block in iter(lambda: f.read(1 << 20), b''): self.digest.update(block)
+        self.offset = data_end
+
+    def _ingest_snapshot(self, size):
+        df = read_snapshot(self.snapshot_path)
+        if df.attrs.get('snapshot_version') != SNAPSHOT_VERSION: return self._ingest_full(size)
+        self.df, self.columns = df, list(pd.read_csv(self.csv_path, nrows=0).columns)
+        self.digest, self.offset, self.clean_end = file_digest(self.csv_path, size), size, self._ends_with_newline(size)
+
+    def _ingest_full(self, size):
+        # 整檔讀到 EOF (與 read_inventory 相同)：最後一列沒有換行也要算進去
+        known = pd.Series(np.arange(len(self.df)), index=self.df['row_hash'].to_numpy()) if 'row_hash' in self.df.columns else pd.Series(dtype=np.int64)
+        known = known[~known.index.duplicated()]
+        reused, fresh, pos = [], [], 0
+        with io.BufferedReader(FileRange(self.csv_path, 0, size)) as f:  # 停在 size，期間追加的列留給下次 _ingest_tail
+            for chunk in pd.read_csv(f, on_bad_lines='skip', chunksize=CSV_CHUNK_ROWS):
+                self.columns = list(chunk.columns)
+                chunk['_pos'] = np.arange(len(chunk)) + pos
+                pos += len(chunk)
+                hashes = hash_rows(chunk)
+                match = known.reindex(hashes).to_numpy()
+                hit = ~np.isnan(match)
+                if hit.any(): reused.append(self.df.iloc[match[hit].astype(np.int64)].assign(_pos=chunk['_pos'].to_numpy()[hit]))
+                if (~hit).any():
+                    new_rows = chunk[~hit].copy()
+                    new_rows['row_hash'] = hashes[~hit]
+                    fresh.append(prepare_inventory(new_rows))
+        self.df = merge_inventory(reused + fresh) if reused or fresh else pd.DataFrame()
+        self.digest, self.offset, self.clean_end = file_digest(self.csv_path, size), size, self._ends_with_newline(size)
+
+# 行情模型：用整份庫存擬合折舊曲線，估「同品牌/車系/年份/里程的車在拍場通常成交多少」
+PRICE_MODEL_PATH = os.environ.get("PRICE_MODEL_PATH", "price_model.json")  # 多副本請指到共用磁碟
+PRICE_MODEL_VERSION = 2  # PriceModel 擬合方式改動時 +1，舊檔自動重擬合
+RETAIL_MARKUP = 1.18     # 同級車拍場行情 → 零售市價
+AUCTION_FEE_RATE = 1.05  # 代標總成本 = 底價 + 手續費
+PRICE_SHRINK = {'brand': 5.0, 'slope': 10.0, 'model': 3.0, 'year': 2.0}  # 樣本少的群組往上一層收斂 (等效列數)
+PRICE_CLIP_QUANTILES = (0.01, 0.99)  # 車齡、里程截在擬合資料的分位數內，不讓 9,999,999 km 之類的哨兵值把線性外插推到 0
+
+def _mileage(df):
+    # 萬公里；0 km 在拍場資料裡代表「未填」，當成缺值
+    km = df['mileage_km'].to_numpy(dtype='float64', na_value=np.nan) / 10000
+    return np.where(km > 0, km, np.nan)
+
+class PriceModel:
+    """log(底價) 的階層式折舊模型，所有群組統計都是一次 bincount / groupby 算完。
+
+    - 全體：log 底價 ~ 車齡 + 里程 (最小平方法)
+    - 品牌：各自的截距與車齡、里程斜率 (ridge 往全體係數收斂，一次解完所有品牌的 2x2 方程)
+    - 車系、車系 × 年份：品牌曲線殘差的平均，依樣本數收斂到 0
+    擬合結果只有幾張小表，可存成 JSON；predict 對整份庫存一次查表算完。
+    """
+    def __init__(self, dataset_version, meta, brands, models, years):
+        self.dataset_version, self.meta = dataset_version, meta
+        self.brands, self.models, self.years = brands, models, years
+
+    def _features(self, df):
+        # 車齡 (以庫存最新年份為 0) 與里程 (萬公里)；缺年份用中位數，缺里程用同車齡的中位數；都截在擬合範圍內
+        meta = self.meta
+        age = meta['ref_year'] - df['year'].to_numpy(dtype='float64', na_value=np.nan)
+        age = np.where(np.isnan(age), meta['age_fill'], np.clip(age, *meta['age_range']))
+        km = _mileage(df)
+        km_by_age = pd.Series(dict(map(tuple, meta['km_by_age'])), dtype='float64')
+        km_fill = km_by_age.reindex(np.rint(age)).fillna(meta['km_fill']).to_numpy()
+        return age, np.clip(np.where(np.isnan(km), km_fill, km), *meta['km_range'])
+
+    @staticmethod
+    def _keys(df, with_year=False):
+        arrays = [df['Brand'].astype(object).to_numpy(), df['model'].astype(object).to_numpy()]
+        if with_year: arrays.append(df['year'].astype('float64').to_numpy(na_value=np.nan))
+        return pd.MultiIndex.from_arrays(arrays)
+
+    def _brand_curve(self, df, age, km):
+        coef = self.brands.reindex(df['Brand'].astype(object).to_numpy()).to_numpy(copy=True)  # pandas 3 回傳唯讀陣列，下面要補值
+        missing = np.isnan(coef[:, 0])
+        if missing.any(): coef[missing] = self.meta['global']
+        return coef[:, 0] + coef[:, 1] * age + coef[:, 2] * km
+
+    @classmethod
+    def fit(cls, df, dataset_version=None):
+        # 底價 == 里程的列是 PDF 轉檔把里程抄進底價欄，不拿來擬合 (仍會被估價)
+        df = df[df['成本底價'].to_numpy() != df['mileage_km'].to_numpy(dtype='float64', na_value=np.nan)]
+        year = df['year'].to_numpy(dtype='float64', na_value=np.nan)
+        ref_year = float(np.nanmax(year)) if np.isfinite(year).any() else 0.0
+        age_raw = ref_year - year
+        km_raw = pd.Series(_mileage(df))
+        km_by_age = km_raw.groupby(np.rint(age_raw)).median().dropna()
+        quantiles = lambda x: [float(q) for q in np.nanquantile(x, PRICE_CLIP_QUANTILES)] if np.isfinite(x).any() else [0.0, 0.0]
+        meta = {
+            'age_range': [0.0, quantiles(age_raw)[1]], 'km_range': quantiles(km_raw.to_numpy()),  # 車齡下限固定 0：最新年份的車不往上調
+            'ref_year': ref_year, 'age_fill': float(np.nanmedian(age_raw)) if np.isfinite(age_raw).any() else 0.0,
+            'km_fill': float(km_raw.median()) if km_raw.notna().any() else 0.0, 'km_by_age': [[float(k), float(v)] for k, v in km_by_age.items()],
+        }
+        model = cls(dataset_version, meta, None, None, None)
+        age, km = model._features(df)
+        y = np.log(np.maximum(df['成本底價'].to_numpy(dtype='float64'), 1.0))
+        # 全體係數
+        X = np.column_stack([np.ones_like(age), age, km])
+        g0, ga, gk = np.linalg.lstsq(X, y, rcond=None)[0]
+        meta['global'] = [float(g0), float(ga), float(gk)]
+        # 品牌曲線：中心化後的 ridge，斜率往全體斜率收斂，平均值往全體曲線收斂
+        codes, names = pd.factorize(df['Brand'].astype(object))
+        total = lambda w=None: np.bincount(codes, weights=w, minlength=len(names))
+        n = total()
+        ma, mk, my = total(age) / n, total(km) / n, total(y) / n
+        saa, skk, sak = total(age * age) - n * ma * ma, total(km * km) - n * mk * mk, total(age * km) - n * ma * mk
+        say, sky = total(age * y) - n * ma * my, total(km * y) - n * mk * my
+        # ridge 強度跟著特徵變異數走，但至少以 1 (年² / 萬公里²) 計：整份資料沒有里程 (或只有單一年份) 時方程才不會奇異
+        la, lk = PRICE_SHRINK['slope'] * max(age.var(), 1.0), PRICE_SHRINK['slope'] * max(km.var(), 1.0)
+        lhs = np.stack([np.stack([saa + la, sak], -1), np.stack([sak, skk + lk], -1)], -2)
+        slopes = np.linalg.solve(lhs, np.stack([say + la * ga, sky + lk * gk], -1)[..., None])[..., 0]
+        at_means = g0 + ga * ma + gk * mk
+        mean_y = at_means + (my - at_means) * n / (n + PRICE_SHRINK['brand'])
+        intercept = mean_y - slopes[:, 0] * ma - slopes[:, 1] * mk
+        model.brands = pd.DataFrame({'intercept': intercept, 'age': slopes[:, 0], 'km': slopes[:, 1]}, index=pd.Index(names, dtype=object))
+        # 車系與年份：逐層取殘差平均並收斂
+        resid = y - model._brand_curve(df, age, km)
+        grouped = pd.Series(resid).groupby([df['Brand'].astype(object).to_numpy(), df['model'].astype(object).to_numpy()]).agg(['sum', 'count'])
+        model.models = grouped['sum'] / (grouped['count'] + PRICE_SHRINK['model'])
+        resid = resid - model.models.reindex(cls._keys(df)).fillna(0).to_numpy()
+        grouped = pd.Series(resid).groupby([df['Brand'].astype(object).to_numpy(), df['model'].astype(object).to_numpy(), year]).agg(['sum', 'count'])
+        model.years = grouped['sum'] / (grouped['count'] + PRICE_SHRINK['year'])
+        return model
+
+    def predict(self, df):
+        # 同級車的拍場行情 (元)
+        age, km = self._features(df)
+        log_price = self._brand_curve(df, age, km)
+        log_price += self.models.reindex(self._keys(df)).fillna(0).to_numpy()
+        log_price += self.years.reindex(self._keys(df, with_year=True)).fillna(0).to_numpy()
+        return np.exp(log_price)
+
+    def save(self, path=PRICE_MODEL_PATH):
+        data = {
+            'price_model_version': PRICE_MODEL_VERSION, 'dataset_version': self.dataset_version, 'meta': self.meta,
+            'brands': {brand: list(row) for brand, row in zip(self.brands.index, self.brands.to_numpy().tolist())},
+            'models': [[*key, value] for key, value in self.models.items()],
+            'years': [[*key, value] for key, value in self.years.items()],
+        }
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=PRICE_MODEL_PATH):
+        with open(path, encoding='utf-8') as f: data = json.load(f)
+        if data.get('price_model_version') != PRICE_MODEL_VERSION: raise ValueError("行情表版本不符")
+        brands = pd.DataFrame.from_dict(data['brands'], orient='index', columns=['intercept', 'age', 'km'])
+        models = pd.Series([row[-1] for row in data['models']], index=pd.MultiIndex.from_tuples([tuple(row[:-1]) for row in data['models']]), dtype='float64')
+        years = pd.Series([row[-1] for row in data['years']], index=pd.MultiIndex.from_tuples([tuple(row[:-1]) for row in data['years']]), dtype='float64')
+        return cls(data['dataset_version'], data['meta'], brands, models, years)
+
+def load_price_model(df, path=PRICE_MODEL_PATH):
+    # 每個資料版本只擬合一次：磁碟上有同版本的行情表就直接讀 (重啟、其他 worker 都不用重算)
+    version = df.attrs.get('dataset_version')
+    try: model = PriceModel.load(path)
+    except (OSError, ValueError, KeyError, TypeError): model = None
+    if model is None or model.dataset_version != version:
+        model = PriceModel.fit(df, version)
+        try: model.save(path)
+        except OSError: pass  # 唯讀磁碟就只留在記憶體
+    return model
+
+def add_market_prices(df, model):
+    # 整份庫存一次估價，推薦時直接讀欄位
+    market = np.rint(model.predict(df) * RETAIL_MARKUP)
+    df['預估市價'] = np.clip(market, 0, np.iinfo(PRICE_DTYPE).max).astype(PRICE_DTYPE)
+    return df
+
+def price_inventory(df, path=PRICE_MODEL_PATH):
+    # 載入庫存時估價；行情模型擬合或估價失敗不能讓整份庫存下線，退回固定加成 (底價 × RETAIL_MARKUP)
+    try: return add_market_prices(df, load_price_model(df, path))
+    except Exception:
+        market = np.rint(df['成本底價'].to_numpy(dtype='float64') * RETAIL_MARKUP)
+        df['預估市價'] = np.clip(market, 0, np.iinfo(PRICE_DTYPE).max).astype(PRICE_DTYPE)
+        return df
+
+# ==========================================
+# 2. 推薦演算法
+# ==========================================
+# 關鍵字群組：載入時每組編譯成一條 regex，預先算成 kw_* 布林欄位
+SUV_KEYWORDS = ['CR-V', 'RAV4', 'KUGA', 'X-TRAIL', 'SUV', 'CX-5', 'ODYSSEY', 'GLC', 'RX', 'NX', 'TIGUAN', 'SPORTAGE', 'TUCSON', 'OUTLANDER', 'URX', 'SIENTA', 'CROSS', 'HR-V']
+MPV_KEYWORDS = ['PREVIA', 'SIENNA', 'ALPHARD', 'ODYSSEY', 'M7', 'WISH', 'SHARAN', 'TOURAN', 'CARENS', 'HIACE']
+KEYWORD_GROUPS = {
+    'eco': ['ALTIS', 'VIOS', 'YARIS', 'FIT', 'PRIUS', 'HYBRID', 'CITY', 'MARCH', 'COLT', 'SENTRA'],
+    'suv': SUV_KEYWORDS,
+    'mpv': MPV_KEYWORDS,
+    'small': ['YARIS', 'VIOS', 'MARCH', 'FIT', '86', 'MX-5'],
+    'commute': ['ALTIS', 'COROLLA', 'CAMRY', 'RAV4', 'CROSS', 'WISH'],
+    'luxury': ['BENZ', 'BMW', 'LEXUS', 'AUDI', 'VOLVO', 'PORSCHE'],
+    'mass': ['TOYOTA', 'HONDA', 'NISSAN'],
+    'sport': ['BMW', 'FOCUS', 'GOLF', 'MAZDA', 'MX-5', '86', 'WRX', 'COOPER', 'MUSTANG', 'ST', 'GTI', 'SUPRA', 'GR', 'AURIS'],
+    'crossover': ['RAV4', 'CR-V', 'X-TRAIL'],
+    'toyota_sport': ['86', 'SUPRA', 'GR', 'AURIS', 'SPORT', 'CH-R'],
+    'starter': ['VIOS', 'YARIS', 'COLT', 'TIIDA', 'MARCH', 'FOCUS', 'LIVINA'],
+}
+KEYWORD_PATTERNS = {group: re.compile('|'.join(re.escape(k) for k in kws)) for group, kws in KEYWORD_GROUPS.items()}
+
+# 用途權重表：(加分, 任一命中的群組, 不可命中的群組, 限定品牌)；任一群組為空 = 無條件
+USAGE_RULES = {
+    "極致省油代步": [(50, ('eco',), (), None), (-1000, ('suv', 'mpv'), ('eco',), None)],
+    "家庭舒適空間": [(50, ('mpv', 'suv'), (), None), (-1000, ('small',), ('mpv', 'suv'), None)],
+    "業務通勤耐操": [(50, ('commute',), (), None)],
+    "面子社交商務": [(50, ('luxury',), (), None), (-10, ('mass',), ('luxury',), None)],
+    "熱血操控樂趣": [(50, ('sport',), (), None), (-10000, ('mpv',), (), None), (-500, ('crossover',), (), None),
+                 (20, ('toyota_sport',), (), 'TOYOTA'), (-50, (), ('toyota_sport',), 'TOYOTA')],
+    "新手練車 (高折舊)": [(50, ('starter',), (), None)],
+}
+ALL_BRANDS = "不限 (所有品牌)"
+BRAND_PREF_BONUS = 200
+
+def add_keyword_flags(df):
+    for group, pattern in KEYWORD_PATTERNS.items():
+        df[f'kw_{group}'] = df['車款名稱'].str.contains(pattern, regex=True).to_numpy(dtype=bool)
+    return df
+
+def brand_mask(brands, brand):
+    # category 欄位直接比對代碼，不展開成字串陣列
+    if not isinstance(brands.dtype, pd.CategoricalDtype): return brands.to_numpy() == brand
+    code = brands.cat.categories.get_indexer([brand])[0]
+    return brands.cat.codes.to_numpy() == code if code >= 0 else np.zeros(len(brands), dtype=bool)
+
+def score_candidates(candidates, usage, brand_pref):
+    # 各規則命中就加上權重；kw_* 欄位逐欄 OR，切片的欄位陣列不複製
+    n = len(candidates)
+    scores = np.zeros(n, dtype=np.int64)
+    for weight, any_of, none_of, brand in USAGE_RULES.get(usage, []):
+        hit = np.ones(n, dtype=bool)
+        if any_of: hit &= np.logical_or.reduce([candidates[f'kw_{g}'].to_numpy() for g in any_of])
+        for g in none_of: hit &= ~candidates[f'kw_{g}'].to_numpy()
+        if brand: hit &= brand_mask(candidates['Brand'], brand)
+        np.add(scores, weight, out=scores, where=hit)
+    if brand_pref != ALL_BRANDS: np.add(scores, BRAND_PREF_BONUS, out=scores, where=brand_mask(candidates['Brand'], brand_pref))
+    return scores
+
+RECOMMEND_TOP_N = 3  # 每次推薦幾台
+ROLE_HERO = '🏆 首選推薦'
+ROLE_PICKS = ['💎 優質精選', '⚔️ 強力競品']  # 依入選順序；之後的都是 ROLE_CROSS
+ROLE_CROSS = '⚖️ 跨界對比'
+ROLE_FILLER = '🔥 熱門候補'
+
+def select_diverse(brands, scores, spreads, brand_pref, top_n=RECOMMEND_TOP_N):
+    """依 (分數, 價差) 排名挑車：指定品牌的首選 + 每個品牌各一台，不足再依序補。
+
+    回傳 (候選列的位置陣列, 角色清單)；車名已事先去重，所以只需確保品牌不重複。
+    """
+    order = np.lexsort((-spreads, -scores))
+    codes = pd.factorize(brands[order])[0]
+    picks, roles = [], []
+    if brand_pref != ALL_BRANDS:
+        hero = np.flatnonzero((brands[order] == brand_pref) & (scores[order] > 0))
+        if hero.size:
+            picks.append(hero[0])
+            roles.append(ROLE_HERO)
+    _, firsts = np.unique(codes, return_index=True)  # 每個品牌排名最前的一台
+    firsts.sort()
+    if picks: firsts = firsts[codes[firsts] != codes[picks[0]]]
+    for rank in firsts[:max(top_n - len(picks), 0)]:
+        roles.append(ROLE_PICKS[len(picks)] if len(picks) < len(ROLE_PICKS) else ROLE_CROSS)
+        picks.append(rank)
+    if len(picks) < top_n:
+        rest = np.ones(len(order), dtype=bool)
+        rest[picks] = False
+        fillers = np.flatnonzero(rest)[:top_n - len(picks)]
+        picks.extend(fillers)
+        roles.extend([ROLE_FILLER] * len(fillers))
+    return order[np.asarray(picks, dtype=np.intp)], roles
+
+def plain_strings(rows):
+    # 入選的幾列：類別欄位換回一般字串 (給 assign)，不帶著整份庫存的類別字典 (pickle 後每筆從 ~75 KB 降到 ~4 KB)
+    return {c: rows[c].to_numpy() for c, dtype in rows.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)}
+
+def recommend_cars(df, budget_limit, usage, brand_pref, top_n=RECOMMEND_TOP_N, timer=None):
+    timer = timer or NULL_TIMER
+    budget_max = budget_limit * 10000
+    budget_min = budget_max * 0.3 
+    with timer.stage('budget_slice'): candidates = df.inventory.budget_slice(budget_min, budget_max)
+    if candidates.empty: return pd.DataFrame()
+    
+    # 切片是共用庫存的唯讀 view：評分、去重都在陣列上做，最後只取出入選的幾列
+    with timer.stage('score'):
+        scores = score_candidates(candidates, usage, brand_pref)
+        keep = np.flatnonzero(scores > -100)
+    with timer.stage('dedup'):
+        names = candidates['車款名稱']
+        codes = names.cat.codes.to_numpy() if isinstance(names.dtype, pd.CategoricalDtype) else pd.factorize(names)[0]
+        keep = keep[np.sort(np.unique(codes[keep], return_index=True)[1])]  # 切片已依底價排序，同名留下最便宜的一台
+
+    if not keep.size: return pd.DataFrame()
+    with timer.stage('select'):
+        prices = candidates['成本底價'].to_numpy()[keep]
+        market = candidates['預估市價'].to_numpy()[keep] if '預估市價' in candidates.columns else prices * RETAIL_MARKUP
+        total_cost = prices * AUCTION_FEE_RATE
+        positions, roles = select_diverse(candidates['Brand'].iloc[keep].to_numpy(), scores[keep], market - total_cost, brand_pref, top_n)
+        rows = candidates.iloc[keep[positions]]
+        return rows.assign(**plain_strings(rows), match_score=scores[keep[positions]], 預估市價=market[positions], 代標總成本=total_cost[positions], 潛在省錢=(market - total_cost)[positions], Role=roles)
+
+# 相似車款：每台車一個特徵向量 (單位已縮放成「差 1 約等於明顯不同級」)，最近鄰 = 同級可比的車
+SIMILAR_TOP_K = 3
+SIMILAR_SCALES = {'price': 0.15, 'year': 2.0, 'km': 5.0}  # log 市價差 0.15 (約 15%)、2 年、5 萬公里
+SIMILAR_BODY_WEIGHT = 1.0   # SUV / MPV 車型不同
+SIMILAR_USAGE_WEIGHT = 0.5  # 各用途的加減分方向 (+/0/-) 不同
+SIMILAR_CELL = 0.5          # 網格邊長 (縮放後單位)，只對 市價 × 年份 兩維分格
+
+def similarity_features(df):
+    # n × d float32：log 市價、年份、里程、SUV、MPV、各用途分數的正負號
+    price = df['預估市價'] if '預估市價' in df.columns else df['成本底價']
+    year = df['year'].to_numpy(dtype='float64', na_value=np.nan)
+    year = np.where(np.isnan(year), np.nanmedian(year) if np.isfinite(year).any() else 0.0, year)
+    km = pd.Series(_mileage(df))
+    km = km.fillna(km.groupby(year).transform('median')).fillna(km.median() if km.notna().any() else 0.0).to_numpy()
+    columns = [np.log(np.maximum(price.to_numpy(dtype='float64'), 1.0)) / SIMILAR_SCALES['price'], year / SIMILAR_SCALES['year'], km / SIMILAR_SCALES['km'],
+               df['kw_suv'].to_numpy() * SIMILAR_BODY_WEIGHT, df['kw_mpv'].to_numpy() * SIMILAR_BODY_WEIGHT]
+    columns += [np.sign(score_candidates(df, usage, ALL_BRANDS)) * SIMILAR_USAGE_WEIGHT for usage in USAGE_RULES]
+    return np.column_stack(columns).astype(np.float32)
+
+def _ranges(starts, ends):
+    # 多段 [start, end) 串成一個位置陣列
+    lengths = ends - starts
+    total = lengths.sum()
+    if not total: return np.empty(0, dtype=np.intp)
+    offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+    return offsets + np.arange(total)
+
+@register_cached_accessor("similar")
+class SimilarityIndex:
+    """相似車款索引：df.similar 第一次存取時建立，之後快取在同一個 DataFrame 物件上。
+
+    車型與用途維度只有少數幾種組合 (profile)；每個 profile 內再依 (市價, 年份) 分格，
+    列依 (profile, 格子) 排序並記下每格的起訖位置。查詢從所在格子一圈一圈往外找：
+    第 r 圈的車在這兩維上至少差 (r - 1) × 格寬，加上 profile 之間的距離就是下限，
+    下限已經比第 k 名遠的 profile 不再掃描；全部 profile 都掃不到更近的就停，結果與暴力搜尋相同。
+    """
+    def __init__(self, df):
+        features = similarity_features(df)
+        # 車型 (0/1) 與用途正負號 (-1/0/1) 編成一個整數，比多欄 unique 快得多
+        levels = np.rint(features[:, 3:] / np.repeat([SIMILAR_BODY_WEIGHT, SIMILAR_USAGE_WEIGHT], [2, len(USAGE_RULES)])).astype(np.int64) + 1
+        _, first, profile_ids = np.unique(levels @ 3 ** np.arange(levels.shape[1]), return_index=True, return_inverse=True)
+        self.profiles = features[first, 3:]
+        cells = np.floor(features[:, :2] / SIMILAR_CELL).astype(np.int64)
+        self.origin = cells.min(axis=0) if len(cells) else np.zeros(2, dtype=np.int64)
+        self.shape = (cells.max(axis=0) - self.origin + 1) if len(cells) else np.ones(2, dtype=np.int64)
+        cells -= self.origin
+        self.n_cells = int(self.shape[0] * self.shape[1])
+        cell_ids = profile_ids.ravel() * self.n_cells + cells[:, 0] * self.shape[1] + cells[:, 1]
+        order = np.argsort(cell_ids, kind='stable')
+        self.frame, self.rows, self.features = df, order, features[order]
+        self.offsets = np.searchsorted(cell_ids[order], np.arange(len(self.profiles) * self.n_cells + 1))
+        brand_codes, brands = pd.factorize(df['Brand'].astype(object))
+        self.brand_codes, self.brand_lookup = brand_codes[order], {brand: code for code, brand in enumerate(brands)}
+        self.name_codes = pd.factorize(df['車款名稱'].astype(object))[0][order]
+        self.prices = df['成本底價'].to_numpy()[order]
+        hashes = df['row_hash'].to_numpy()[order]
+        self.hash_slots = np.argsort(hashes, kind='stable')  # row_hash → 索引內位置，結果卡片直接取已算好的向量
+        self.hash_sorted = hashes[self.hash_slots]
+
+    def vector_of(self, car):
+        # 庫存裡的車以 row_hash 取回向量；找不到 (例如資料更新前的舊結果) 才現算
+        if 'row_hash' in car.columns:
+            h = car['row_hash'].iloc[0]
+            i = np.searchsorted(self.hash_sorted, h)
+            if i < len(self.hash_sorted) and self.hash_sorted[i] == h: return self.features[self.hash_slots[i]]
+        return similarity_features(car)[0]
+
+    def _ring(self, center, r):
+        # 第 r 圈 (Chebyshev 距離 = r) 且在網格內的格子編號
+        xs = np.arange(center[0] - r, center[0] + r + 1)
+        ys = np.arange(center[1] - r, center[1] + r + 1)
+        gx, gy = np.meshgrid(xs, ys, indexing='ij')
+        on_ring = (np.maximum(np.abs(gx - center[0]), np.abs(gy - center[1])) == r) & (gx >= 0) & (gx < self.shape[0]) & (gy >= 0) & (gy < self.shape[1])
+        return gx[on_ring] * self.shape[1] + gy[on_ring]
+
+    def nearest(self, vector, brand=None, k=SIMILAR_TOP_K, max_price=None):
+        """特徵向量 → 最接近的 k 台 (排除 brand、底價超過 max_price 的車，同名只留最近的一台)。
+
+        回傳 (庫存列位置陣列, 距離陣列)，依距離由近到遠。
+        """
+        center = np.clip(np.floor(vector[:2] / SIMILAR_CELL).astype(np.int64) - self.origin, 0, self.shape - 1)
+        profile_gap = ((self.profiles - vector[3:]) ** 2).sum(axis=1)
+        exclude = self.brand_lookup.get(brand, -2)
+        positions, distances = np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        for r in range(int(self.shape.max()) + 1):
+            kth = distances[-1] if len(positions) >= k else np.inf
+            lower = profile_gap + (max(r - 1, 0) * SIMILAR_CELL) ** 2  # 各 profile 第 r 圈的距離下限 (平方)
+            if lower.min() > kth ** 2: break
+            active = np.flatnonzero(lower <= kth ** 2)
+            ids = (active[:, None] * self.n_cells + self._ring(center, r)[None, :]).ravel()
+            found = _ranges(self.offsets[ids], self.offsets[ids + 1])
+            if max_price is not None: found = found[self.prices[found] <= max_price]
+            found = found[self.brand_codes[found] != exclude]
+            if not found.size: continue
+            positions = np.concatenate([positions, found])
+            distances = np.concatenate([distances, np.sqrt(((self.features[found] - vector) ** 2).sum(axis=1))])
+            order = np.lexsort((self.rows[positions], distances))
+            _, first = np.unique(self.name_codes[positions[order]], return_index=True)
+            keep = order[np.sort(first)][:k]
+            positions, distances = positions[keep], distances[keep]
+        return self.rows[positions], distances
+
+def similar_cars(df, car, k=SIMILAR_TOP_K, max_price=None):
+    """結果卡片用：car (一列 DataFrame，例如推薦結果的一列) → 庫存裡最接近的 k 台其他品牌車。"""
+    if df.empty or car.empty: return pd.DataFrame()
+    index = df.similar
+    positions, distances = index.nearest(index.vector_of(car), car['Brand'].iloc[0], k, max_price)
+    rows = df.iloc[positions]
+    return rows.assign(**plain_strings(rows), similarity_distance=distances)
+
+USAGE_OPTIONS = list(USAGE_RULES)
+BUDGET_RANGE = (10, 200)  # 預算滑桿 (萬)
+RECOMMEND_CACHE_SIZE = 32768  # 足以放下全部 預算 × 用途 × 品牌 組合
+
+class TTLCache:
+    # 執行緒安全的 LRU + TTL 快取
+    def __init__(self, maxsize=512, ttl=3600):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None: return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize: self._data.popitem(last=False)
+
+class RecommendationCache:
+    """跨 session 共用的推薦結果 LRU；資料版本一變就整個清空。
+
+    存 pickle 後的 bytes (每筆幾 KB；幾列的 DataFrame 物件本身常駐就要 30 KB 上下，預熱兩萬多筆會吃掉近 1 GB)，
+    get 時才還原，每個呼叫端各拿一份複本。
+    """
+    def __init__(self, maxsize=RECOMMEND_CACHE_SIZE):
+        self.version = None
+        self.cache = TTLCache(maxsize=maxsize, ttl=float('inf'))
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        with self._lock:
+            if version != self.version: self.version, self.cache = version, TTLCache(self.cache.maxsize, self.cache.ttl)
+
+    def get(self, df, budget_limit, usage, brand_pref, top_n=RECOMMEND_TOP_N, timer=None):
+        version = df.attrs.get('dataset_version')
+        self._check_version(version)
+        key = (budget_limit, usage, brand_pref) if top_n == RECOMMEND_TOP_N else (budget_limit, usage, brand_pref, top_n)
+        blob = self.cache.get(key)
+        if blob is not None: return pickle.loads(blob)
+        results = recommend_cars(df, budget_limit, usage, brand_pref, top_n, timer)
+        self.put(version, key, pickle.dumps(results, pickle.HIGHEST_PROTOCOL))
+        return results
+
+    def put(self, version, key, blob):
+        if version == self.version: self.cache.set(key, blob)
+
+_WORKER_DF = None
+
+def _init_worker(csv_path, snapshot_path):
+    # process pool worker 的庫存：fork 啟動時直接繼承父行程的；否則自己讀 (快照為 memory-map，各行程共用分頁)
+    global _WORKER_DF
+    if _WORKER_DF is None: _WORKER_DF, _ = read_inventory(csv_path, snapshot_path)
+
+def _warmup_task(usage, brand_pref):
+    # worker 端就序列化好，主行程直接存 bytes
+    return [((budget, usage, brand_pref), pickle.dumps(recommend_cars(_WORKER_DF, budget, usage, brand_pref), pickle.HIGHEST_PROTOCOL)) for budget in range(BUDGET_RANGE[0], BUDGET_RANGE[1] + 1)]
+
+def warm_recommendations(cache, df, max_workers=None):
+    # 背景 process pool 算完所有組合，結果陸續寫進共用快取
+    global _WORKER_DF
+    _WORKER_DF = df
+    version = df.attrs.get('dataset_version')
+    cache._check_version(version)
+    brands = [ALL_BRANDS] + sorted(df['Brand'].unique().tolist())
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(CSV_PATH, SNAPSHOT_PATH)) as pool:
+        futures = [pool.submit(_warmup_task, usage, brand) for usage in USAGE_OPTIONS for brand in brands]
+        for future in as_completed(futures):
+            try: batch = future.result()
+            except Exception: continue  # 預熱只是加速，失敗的組合留給查詢時再算
+            for key, blob in batch: cache.put(version, key, blob)
+
+RESULT_FIELDS = ['車款名稱', 'Brand', 'model', 'year', 'mileage_km', 'grade', '成本底價', '預估市價', '代標總成本', '潛在省錢', 'match_score', 'Role']
+
+def parse_query(query):
+    """{"budget": 70, "usage": "家庭舒適空間", "brand": "TOYOTA", "top_n": 3} → recommend_cars 參數；格式錯誤丟 ValueError。"""
+    if not isinstance(query, dict): raise ValueError("query 必須是 JSON 物件")
+    try: budget = int(query['budget'])
+    except (KeyError, TypeError, ValueError, OverflowError): raise ValueError("budget 必須是整數 (萬)")  # OverflowError：inf / 1e309
+    if not BUDGET_RANGE[0] <= budget <= BUDGET_RANGE[1]: raise ValueError(f"budget 必須介於 {BUDGET_RANGE[0]}~{BUDGET_RANGE[1]} 萬")
+    usage = query.get('usage')
+    if usage not in USAGE_RULES: raise ValueError(f"usage 必須是 {USAGE_OPTIONS} 之一")
+    brand = query.get('brand') or ALL_BRANDS
+    if not isinstance(brand, str): raise ValueError("brand 必須是字串")
+    try: top_n = int(query.get('top_n', RECOMMEND_TOP_N))
+    except (TypeError, ValueError, OverflowError): raise ValueError("top_n 必須是整數")
+    if not 1 <= top_n <= 50: raise ValueError("top_n 必須介於 1~50")
+    return budget, usage, brand, top_n
+
+def results_to_records(results):
+    # DataFrame → 可直接 json.dumps 的 list[dict] (NA → None、numpy 數值 → Python 數值)
+    if results.empty: return []
+    out = results[[c for c in RESULT_FIELDS if c in results.columns]].astype(object)
+    return out.where(out.notna(), None).to_dict('records')
+
+QUERY_FAILED = "查詢失敗"  # 執行期錯誤的前綴 (API 回 500；其餘 error 屬查詢格式錯誤，回 400)
+
+def run_query(df, query, cache=None):
+    # API 與批次共用：單筆查詢 → 回應 dict；查詢格式錯誤或執行失敗時回傳 {"error": ...}，不讓單筆拖垮整批
+    response = {'id': query['id']} if isinstance(query, dict) and 'id' in query else {}
+    try:
+        try: budget, usage, brand, top_n = parse_query(query)
+        except ValueError as e: return {**response, 'error': str(e)}
+        results = cache.get(df, budget, usage, brand, top_n) if cache is not None else recommend_cars(df, budget, usage, brand, top_n)
+        return {**response, 'dataset_version': df.attrs.get('dataset_version'), 'results': results_to_records(results)}
+    except Exception as e: return {**response, 'error': f"{QUERY_FAILED}: {type(e).__name__}: {e}"}
+
+def _run_query_worker(query):
+    return run_query(_WORKER_DF, query)
+
+def run_queries(queries, csv_path=CSV_PATH, snapshot_path=SNAPSHOT_PATH, max_workers=None, chunksize=64):
+    """批次查詢：多個 process 共用同一份唯讀、memory-map 的庫存快照，依輸入順序產出結果。"""
+    if not snapshot_is_fresh(csv_path, snapshot_path) or read_snapshot(snapshot_path).attrs.get('snapshot_version') != SNAPSHOT_VERSION:
+        build_snapshot(csv_path, snapshot_path)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(csv_path, snapshot_path)) as pool:
+        yield from pool.map(_run_query_worker, queries, chunksize=chunksize)
+
+# ==========================================
+# 3. AI 投資顧問
+# ==========================================
+ADVICE_MAX_WORKERS = 4   # 同時送出的 Gemini 請求上限
+ADVICE_TIMEOUT = 15.0    # 整批卡片共用的期限 (秒，從送出起算)，期限內沒回來的卡片改用 ADVICE_FALLBACK
+ADVICE_PROMPT_VERSION = 2  # 改 build_advice_prompt 時 +1，舊快取自然失效
+ADVICE_DB_PATH = os.environ.get("ADVICE_DB_PATH", "advice_cache.sqlite3")  # 同一台主機的 worker 共用；須放本機磁碟 (WAL 不支援 NFS/SMB 等網路磁碟)，每台主機各一份
+ADVICE_STATS_FLUSH = 1.0  # 秒；命中統計與 last_used 先記在記憶體，最多這麼久批次寫回一次
+ADVICE_FALLBACK = "AI 分析：數據顯示此車款目前位於折舊甜蜜點，拍場價格極具優勢。"
+
+def build_advice_prompt(car_name, wholesale_price, market_price, savings):
+    return f"你是投資汽車顧問。標的：{car_name} (市價{int(market_price/10000)}萬 vs 底價{int(wholesale_price/10000)}萬)。請用60字內給出建議，Strong Buy。"
+
+class SQLiteAdviceCache:
+    """同一台主機上跨 session / 多 worker 共用的建議快取 (SQLite WAL)。key = (車款名稱, 底價萬元區間, prompt 版本)。
+
+    get 只做 SELECT，讀取之間不互相排隊；命中/未命中次數與 last_used 先累積在記憶體，
+    由 get 順手批次寫回 advice_stats (拿不到寫入鎖就留到下次，不等待)；set、stats()、flush() 會等到寫入為止。
+    """
+    def __init__(self, path, maxsize=50000, ttl=7 * 86400):
+        self.path, self.maxsize, self.ttl = path, maxsize, ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counts, self._touched, self._flushed_at = {'hits': 0, 'misses': 0}, {}, 0.0
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS advice (name TEXT, bucket INTEGER, version INTEGER, text TEXT NOT NULL, expires_at REAL NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (name, bucket, version))")
+            conn.execute("CREATE INDEX IF NOT EXISTS advice_last_used ON advice (last_used)")
+            conn.execute("CREATE TABLE IF NOT EXISTS advice_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO advice_stats VALUES ('hits', 0), ('misses', 0), ('evictions', 0)")
+
+    def _conn(self):
+        # sqlite3 連線不能跨執行緒共用，每條執行緒各開一條
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        row = self._conn().execute("SELECT text FROM advice WHERE name = ? AND bucket = ? AND version = ? AND expires_at > ?", (*key, now)).fetchone()
+        with self._lock:
+            self._counts['hits' if row else 'misses'] += 1
+            if row: self._touched[key] = now
+        if now - self._flushed_at >= ADVICE_STATS_FLUSH: self._flush(wait=False)
+        return row[0] if row else None
+
+    def _flush(self, wait):
+        # 把累積的統計與 last_used 一次寫回；wait=False 時寫入鎖被占用就放回去，下次再寫
+        with self._lock:
+            counts, touched = self._counts, self._touched
+            self._counts, self._touched, self._flushed_at = {'hits': 0, 'misses': 0}, {}, time.time()
+        if not touched and not any(counts.values()): return
+        conn = self._conn()
+        if not wait: conn.execute("PRAGMA busy_timeout = 0")
+        try:
+            with conn:
+                conn.executemany("UPDATE advice SET last_used = MAX(last_used, ?) WHERE name = ? AND bucket = ? AND version = ?", [(t, *k) for k, t in touched.items()])
+                conn.executemany("UPDATE advice_stats SET value = value + ? WHERE name = ?", [(v, name) for name, v in counts.items() if v])
+        except sqlite3.Error:
+            with self._lock:
+                for name, v in counts.items(): self._counts[name] += v
+                for k, t in touched.items(): self._touched[k] = max(t, self._touched.get(k, 0.0))
+            if wait: raise
+        finally:
+            if not wait: conn.execute("PRAGMA busy_timeout = 5000")
+
+    def flush(self):
+        self._flush(wait=True)
+
+    def set(self, key, value):
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO advice VALUES (?, ?, ?, ?, ?, ?)", (*key, value, now + self.ttl, now))
+            evicted = conn.execute("DELETE FROM advice WHERE expires_at <= ?", (now,)).rowcount
+            overflow = conn.execute("SELECT COUNT(*) FROM advice").fetchone()[0] - self.maxsize
+            if overflow > 0: evicted += conn.execute("DELETE FROM advice WHERE rowid IN (SELECT rowid FROM advice ORDER BY last_used LIMIT ?)", (overflow,)).rowcount
+            if evicted: conn.execute("UPDATE advice_stats SET value = value + ? WHERE name = 'evictions'", (evicted,))
+        self.flush()  # 本來就在寫，順便把累積的統計寫回
+
+    def stats(self):
+        self.flush()
+        return read_advice_stats(self._conn())
+
+def read_advice_stats(conn):
+    stats = dict(conn.execute("SELECT name, value FROM advice_stats").fetchall())
+    stats['entries'] = conn.execute("SELECT COUNT(*) FROM advice").fetchone()[0]
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+def advice_cache_stats(path=ADVICE_DB_PATH):
+    # 給 /metrics 等外部讀取：唯讀開啟，不建表、不寫入；快取檔還不存在時回傳 None
+    if not os.path.exists(path): return None
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=1.0)
+    try: return read_advice_stats(conn)
+    finally: conn.close()
+
+class AdviceService:
+    """一次送出所有卡片的 prompt；model 只要有 generate_content(prompt).text 即可 (可換成本地 stub)。"""
+    def __init__(self, model, max_workers=ADVICE_MAX_WORKERS, timeout=ADVICE_TIMEOUT, cache=None):
+        self.model = model
+        self.timeout = timeout
+        self.cache = cache if cache is not None else TTLCache()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="advice")
+
+    @staticmethod
+    def cache_key(car_name, wholesale_price):
+        return (' '.join(str(car_name).upper().split()), int(wholesale_price / 10000), ADVICE_PROMPT_VERSION)
+
+    def _generate(self, prompt):
+        return self.model.generate_content(prompt).text
+
+    def fetch_many(self, cards):
+        """cards: [(car_name, wholesale_price, market_price, savings), ...]，依序回傳建議文字。"""
+        results, pending = [None] * len(cards), {}
+        for i, card in enumerate(cards):
+            key = self.cache_key(card[0], card[1])
+            try: results[i] = self.cache.get(key)
+            except Exception: results[i] = None  # 快取讀不到 (例如 database is locked) 就當未命中
+            if results[i] is None and key not in pending: pending[key] = self._pool.submit(self._generate, build_advice_prompt(*card))
+        deadline, late = time.monotonic() + self.timeout, set()  # 整批共用一個期限，避免逐張卡片累加等待
+        for i, card in enumerate(cards):
+            if results[i] is not None: continue
+            key = self.cache_key(card[0], card[1])
+            try: results[i] = pending[key].result(timeout=max(0.0, deadline - time.monotonic()))
+            except Exception:
+                results[i] = ADVICE_FALLBACK
+                late.add(key)
+                continue
+            self._store(key, results[i])
+        # 沒趕上期限的請求：還在排隊的取消，免得占住 pool；已經送出的讓它跑完，晚到的結果照樣寫進快取給下一次用
+        for key in late:
+            if not pending[key].cancel(): pending[key].add_done_callback(lambda f, key=key: self._store_late(key, f))
+        return results
+
+    def _store(self, key, text):
+        try: self.cache.set(key, text)
+        except Exception: pass  # 寫不進快取不影響已拿到的建議
+
+    def _store_late(self, key, future):
+        if not future.cancelled() and future.exception() is None: self._store(key, future.result())
+
+# ==========================================
+# 4. 效能量測
+# ==========================================
+class StageTimer:
+    """逐段計時：with timer.stage('score'): ...；同名階段重複進入時累加。
+
+    trace_memory=True 時另記每段的 tracemalloc 峰值 (相對進入時)；numpy/pandas 的配置會被追蹤，
+    Arrow memory-map 的分頁不算。tracemalloc 峰值是全域的，巢狀階段會重設外層峰值；
+    量測本身也有額外開銷，計時與記憶體最好分開跑。
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.seconds, self.peak_bytes, self.calls = OrderedDict(), OrderedDict(), OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        if self.trace_memory:
+            started_here = not tracemalloc.is_tracing()
+            if started_here: tracemalloc.start()
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.seconds.setdefault(name, 0.0)
+        self.calls.setdefault(name, 0)
+        start = time.perf_counter()
+        try: yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+            if self.trace_memory:
+                self.peak_bytes[name] = max(self.peak_bytes.get(name, 0), tracemalloc.get_traced_memory()[1] - baseline)
+                if started_here: tracemalloc.stop()
+
+    def records(self):
+        # [{'stage', 'ms', 'calls', ('peak_mb')}, ...] 依第一次進入的順序
+        return [{'stage': name, 'ms': round(sec * 1000, 3), 'calls': self.calls[name], **({'peak_mb': round(self.peak_bytes[name] / 1e6, 3)} if name in self.peak_bytes else {})} for name, sec in self.seconds.items()]
+
+class _NullTimer:
+    def stage(self, name): return nullcontext()
+
+NULL_TIMER = _NullTimer()  # 沒有傳 timer 時用，不量測